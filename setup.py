@@ -4,7 +4,10 @@ setup(
   name='wadcraft',
   version='0.1',
   entry_points = {
-    'console_scripts': ['wadcraft = wadcraft.main:main']
+    'console_scripts': [
+      'wadcraft = wadcraft.main:main',
+      'wadcraft-server = wadcraft.server:main',
+    ]
   },
   packages=find_packages(exclude=['ez_setup']),
   install_requires=[
@@ -0,0 +1,104 @@
+# Wadcraft is a program converting Doom WAD levels to minecraft format.
+# (C) 2011 Pierre Palatin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+"""Persistent cache of the wool colors of flats and textures.
+
+Keys are content hashes computed by the renderer, so the cache can be shared
+between wads and runs: a flat with the same data, palette and color metric
+always maps to the same wool.
+"""
+
+
+import collections
+import json
+import os
+
+
+_VERSION = 1
+
+
+def default_path():
+  """Cache file used when none is specified."""
+  base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+      os.path.expanduser('~'), '.cache')
+  return os.path.join(base, 'wadcraft', 'colors.json')
+
+
+class ColorCache(object):
+  """Maps keys to wool colors, optionally persisted in a JSON file.
+
+  Entries are kept in least recently used order, and only the max_entries
+  most recently used ones are kept.
+  """
+
+  def __init__(self, path=None, max_entries=8192):
+    self.path = path
+    self.max_entries = max_entries
+    self._entries = collections.OrderedDict()
+    self._dirty = False
+
+  def load(self):
+    """Read the cache file, if any. An unreadable file is ignored."""
+    if not self.path or not os.path.exists(self.path):
+      return
+    try:
+      with open(self.path) as ifile:
+        content = json.load(ifile)
+      if content.get('version') != _VERSION:
+        return
+      for key, value in content['entries']:
+        self._entries[str(key)] = value
+    except (IOError, ValueError, KeyError, TypeError), e:
+      print '   Ignoring color cache %s: %s' % (self.path, e)
+      self._entries.clear()
+    self._evict()
+
+  def save(self):
+    """Write the cache file, if there is one and something changed."""
+    if not self.path or not self._dirty:
+      return
+    dirname = os.path.dirname(self.path)
+    if dirname and not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    # Write then rename, so concurrent runs never see a partial file.
+    tmpname = '%s.%d.tmp' % (self.path, os.getpid())
+    with open(tmpname, 'w') as ofile:
+      json.dump({'version': _VERSION, 'entries': self._entries.items()},
+                ofile)
+    os.rename(tmpname, self.path)
+    self._dirty = False
+
+  def get(self, key):
+    """Returns the color for key, or None."""
+    value = self._entries.pop(key, None)
+    if value is not None:
+      self._entries[key] = value
+    return value
+
+  def put(self, key, value):
+    self._entries.pop(key, None)
+    self._entries[key] = value
+    self._dirty = True
+    self._evict()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def _evict(self):
+    while len(self._entries) > self.max_entries:
+      self._entries.popitem(last=False)
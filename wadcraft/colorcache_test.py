@@ -0,0 +1,75 @@
+# Wadcraft is a program converting Doom WAD levels to minecraft format.
+# (C) 2011 Pierre Palatin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from wadcraft import colorcache
+
+
+class ColorCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmpdir, 'cache', 'colors.json')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_least_recently_used(self):
+    cache = colorcache.ColorCache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    self.assertEqual(cache.get('a'), 1)
+    cache.put('c', 3)
+    self.assertEqual(len(cache), 2)
+    self.assertEqual(cache.get('b'), None)
+    self.assertEqual(cache.get('a'), 1)
+    self.assertEqual(cache.get('c'), 3)
+
+  def test_save_and_load(self):
+    cache = colorcache.ColorCache(self.path)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.save()
+    # Only the cache file is left behind.
+    self.assertEqual(os.listdir(os.path.dirname(self.path)), ['colors.json'])
+
+    loaded = colorcache.ColorCache(self.path, max_entries=1)
+    loaded.load()
+    self.assertEqual(len(loaded), 1)
+    self.assertEqual(loaded.get('b'), 2)
+
+  def test_unchanged_is_not_saved(self):
+    cache = colorcache.ColorCache(self.path)
+    cache.save()
+    self.assertFalse(os.path.exists(self.path))
+
+  def test_invalid_file(self):
+    os.makedirs(os.path.dirname(self.path))
+    with open(self.path, 'w') as ofile:
+      ofile.write('{"version": 1, "entries": [["a", 1], ')
+    cache = colorcache.ColorCache(self.path)
+    cache.load()
+    self.assertEqual(len(cache), 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
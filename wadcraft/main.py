@@ -20,9 +20,10 @@
 
 
 import optparse
-import random
+import os
 import sys
 
+from wadcraft import colorcache
 from wadcraft import waddecode
 from wadcraft import wadutils
 from wadcraft import wadlib
@@ -35,16 +36,45 @@ def main():
   print 'WadCraft by Pierre Palatin (parts based on Wad2PDF by Jussi Pakkanen)'
   print
 
-  # Set a fixed seed to always have the same results
-  random.seed(42)
-
   parser = optparse.OptionParser()
 
   parser.add_option('-i', '--iwad', help='Specify iwad file to use.')
-  parser.add_option('-l', '--level', help='Specify level to convert.')
-  parser.add_option('-o', '--output', 
-                    default='level.schematic',
-                    help='Target schematic file.')
+  parser.add_option('-l', '--level',
+                    help='Specify level to convert; several levels can be '
+                    'given, separated by commas.')
+  parser.add_option('--all-levels', action='store_true', default=False,
+                    help='Convert all levels.')
+  parser.add_option('-o', '--output',
+                    help='Target schematic file, when converting a single '
+                    'level [default: level.schematic].')
+  parser.add_option('--output-dir', default='.',
+                    help='Directory of the schematics, named after their '
+                    'level, when converting several levels '
+                    '[default: %default].')
+  parser.add_option('--list-levels', action='store_true', default=False,
+                    help='List available levels and exit.')
+  parser.add_option('-z', '--compress-level', type='int', default=9,
+                    help='Gzip compression level of the schematic, 1-9.')
+  parser.add_option('-r', '--rotate', type='int', default=0,
+                    help='Rotate the level by this many quarter turns, '
+                    'counterclockwise.')
+  parser.add_option('--raster', type='choice', default='polygons',
+                    choices=list(render.RASTER_ENGINES),
+                    help='How subsectors are turned into blocks: '
+                    '%s [default: %%default].'
+                    % ', '.join(render.RASTER_ENGINES))
+  parser.add_option('--torch-pattern', type='choice', default='hash',
+                    choices=list(render.TORCH_PATTERNS),
+                    help='How torches are spread: %s [default: %%default].'
+                    % ', '.join(render.TORCH_PATTERNS))
+  parser.add_option('-j', '--jobs', type='int', default=1,
+                    help='Number of processes rendering the level, or the '
+                    'levels when converting several of them.')
+  parser.add_option('--color-cache', default=colorcache.default_path(),
+                    help='File caching the colors of flats and textures '
+                    'between runs [default: %default].')
+  parser.add_option('--no-color-cache', action='store_true', default=False,
+                    help='Do not read nor write the color cache.')
 
   (opts, args) = parser.parse_args()
 
@@ -54,42 +84,87 @@ def main():
     parser.print_help()
     sys.exit(1)
 
+  # Only wad directories are needed to know which levels exist.
   rawwad = waddecode.wad()
-  print 'Loading iwad %s ...' % opts.iwad 
-  rawwad.load(opts.iwad)
+  levelnames = rawwad.scanlevels(opts.iwad)
   if rawwad.type != 'IWAD':
     print 'This is not an iwad file (such as doom.wad or doom2.wad).'
     sys.exit(2)
+
+  for fname in args:
+    levelnames += waddecode.wad().scanlevels(fname)
+  levelnames = sorted(set(levelnames))
+
+  selected = []
+  if opts.all_levels and not opts.list_levels:
+    selected = levelnames
+  elif opts.level and not opts.list_levels:
+    for name in [n.strip() for n in opts.level.split(',') if n.strip()]:
+      for levelname in levelnames:
+        if levelname.lower() == name.lower():
+          if levelname not in selected:
+            selected.append(levelname)
+          break
+      else:
+        print 'Unable to find level %s' % name
+        print
+        selected = []
+        break
+
+  batch = opts.all_levels or len(selected) > 1
+  if batch and opts.output:
+    print 'Several levels are converted: use --output-dir instead of --output.'
+    sys.exit(1)
+
+  if not selected:
+    print 'Existing levels:'
+    for levelname in levelnames:
+      print '    %s' % levelname
+    if opts.list_levels:
+      sys.exit(0)
+    sys.exit(3)
+
+  # Now load the wads for real, skipping all other levels. They are loaded
+  # once, whatever the number of levels.
+  print 'Loading iwad %s ...' % opts.iwad 
+  rawwad.load(opts.iwad, mapped=True, levels=selected)
   
   for fname in args:
     print 'Loading pwad %s ...' % fname
     newrawwad = waddecode.wad()
-    newrawwad.load(fname)
+    newrawwad.load(fname, mapped=True, levels=selected)
     wadutils.mergewad(rawwad, newrawwad)
 
   wad = wadlib.Wad(rawwad)
 
   print
 
-  level = None
-  if opts.level:
-    for level in rawwad.levels:
-      if level.header.name.lower() == opts.level.lower():
-        break
-    else:
-      print 'Unable to find level %s' % opts.level
-      print
-      level = None
-
-  if not level:
-    print 'Existing levels:'
-    for level in rawwad.levels:
-      print '    %s' % level.header.name
-    sys.exit(3)
-
-
-  print 'Converting level %s ...' % level.header.name
-  nbtfile = render.render_level(wad, level)
-
-  print 'Writing schematic to %s ...' % opts.output
-  nbtfile.write_file(opts.output)
+  color_cache = colorcache.ColorCache(
+      None if opts.no_color_cache else opts.color_cache)
+  color_cache.load()
+
+  # A single level goes to the output file; batches to the output directory.
+  if not batch:
+    level = rawwad.levelindex[selected[0]]
+    print 'Converting level %s ...' % level.header.name
+    schematic = render.render_level(wad, level, opts.rotate, color_cache,
+                                    opts.raster, opts.jobs,
+                                    opts.torch_pattern)
+    color_cache.save()
+
+    output = opts.output or 'level.schematic'
+    print 'Writing schematic to %s ...' % output
+    schematic.write(output, opts.compress_level)
+    return
+
+  if not os.path.isdir(opts.output_dir):
+    os.makedirs(opts.output_dir)
+
+  def write(levelname, schematic):
+    filename = os.path.join(opts.output_dir, '%s.schematic' % levelname)
+    print 'Writing schematic to %s ...' % filename
+    schematic.write(filename, opts.compress_level)
+
+  render.render_levels(wad, selected, write, opts.rotate, color_cache,
+                       opts.raster, opts.jobs, opts.torch_pattern)
+  color_cache.save()
@@ -19,9 +19,15 @@
 """Minecraft data manipulation library."""
 
 
-import array
+import ctypes
+import gzip
+import multiprocessing
+import struct
+
 import nbt
+from colormath import color_constants
 from colormath import color_objects
+import numpy
 
 
 wool_colors = {
@@ -44,6 +50,101 @@ wool_colors = {
 }
 
 
+def rgb_to_lab(rgb):
+  """Converts 0-255 sRGB colors, in an array of shape (..., 3), to CIE Lab
+  (D65 illuminant, 2 degrees observer), as colormath does."""
+  rgb = numpy.asarray(rgb, numpy.float64) / 255.0
+  linear = numpy.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4,
+                       rgb / 12.92)
+  matrix = color_constants.RGB_SPECS['srgb']['conversions']['rgb_to_xyz']
+  illuminant = color_constants.ILLUMINANTS['2']['d65']
+  xyz = linear.dot(matrix) / illuminant
+  xyz = numpy.where(xyz > color_constants.CIE_E, xyz ** (1.0 / 3.0),
+                    7.787 * xyz + 16.0 / 116.0)
+  x, y, z = xyz[..., 0], xyz[..., 1], xyz[..., 2]
+  return numpy.stack((116.0 * y - 16.0, 500.0 * (x - y), 200.0 * (y - z)),
+                     axis=-1)
+
+
+def delta_e(lab1, lab2):
+  """CIE2000 color difference between arrays of Lab colors, of shape
+  (..., 3). Shapes are broadcast."""
+  lab1 = numpy.asarray(lab1, numpy.float64)
+  lab2 = numpy.asarray(lab2, numpy.float64)
+  L1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+  L2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+
+  avg_Lp = (L1 + L2) / 2.0
+  avg_C = (numpy.hypot(a1, b1) + numpy.hypot(a2, b2)) / 2.0
+  G = 0.5 * (1 - numpy.sqrt(avg_C ** 7.0 / (avg_C ** 7.0 + 25.0 ** 7.0)))
+  a1p = (1.0 + G) * a1
+  a2p = (1.0 + G) * a2
+  C1p = numpy.hypot(a1p, b1)
+  C2p = numpy.hypot(a2p, b2)
+  avg_Cp = (C1p + C2p) / 2.0
+
+  h1p = numpy.degrees(numpy.arctan2(b1, a1p))
+  h1p = numpy.where(h1p >= 0, h1p, h1p + 360)
+  h2p = numpy.degrees(numpy.arctan2(b2, a2p))
+  h2p = numpy.where(h2p >= 0, h2p, h2p + 360)
+  avg_Hp = numpy.where(abs(h1p - h2p) > 180, (h1p + h2p + 360) / 2.0,
+                       (h1p + h2p) / 2.0)
+
+  T = (1 - 0.17 * numpy.cos(numpy.radians(avg_Hp - 30))
+       + 0.24 * numpy.cos(numpy.radians(2 * avg_Hp))
+       + 0.32 * numpy.cos(numpy.radians(3 * avg_Hp + 6))
+       - 0.2 * numpy.cos(numpy.radians(4 * avg_Hp - 63)))
+
+  diff_hp = h2p - h1p
+  delta_hp = numpy.where(abs(diff_hp) <= 180, diff_hp,
+                         numpy.where(h2p <= h1p, diff_hp + 360,
+                                     diff_hp - 360))
+  delta_Lp = L2 - L1
+  delta_Cp = C2p - C1p
+  delta_Hp = 2 * numpy.sqrt(C2p * C1p) * numpy.sin(
+      numpy.radians(delta_hp) / 2.0)
+
+  S_L = 1 + ((0.015 * (avg_Lp - 50) ** 2)
+             / numpy.sqrt(20 + (avg_Lp - 50) ** 2.0))
+  S_C = 1 + 0.045 * avg_Cp
+  S_H = 1 + 0.015 * avg_Cp * T
+  delta_ro = 30 * numpy.exp(-(((avg_Hp - 275) / 25) ** 2.0))
+  R_C = numpy.sqrt(avg_Cp ** 7.0 / (avg_Cp ** 7.0 + 25.0 ** 7.0))
+  R_T = -2 * R_C * numpy.sin(2 * numpy.radians(delta_ro))
+
+  return numpy.sqrt((delta_Lp / S_L) ** 2 + (delta_Cp / S_C) ** 2
+                    + (delta_Hp / S_H) ** 2
+                    + R_T * (delta_Cp / S_C) * (delta_Hp / S_H))
+
+
+# Wool colors, indexed by wool data value.
+wool_rgb = numpy.array([wool_colors[i].get_value_tuple() for i in range(16)])
+wool_lab = rgb_to_lab(wool_rgb)
+
+
+def nearest_wool(rgb, exclude=(0xf,)):
+  """Returns the wool data values of the wools closest to 0-255 RGB colors,
+  in an array of shape (..., 3). Wools in exclude are never picked; by
+  default black, as it makes things really hard to see."""
+  allowed = numpy.setdiff1d(numpy.arange(16), exclude)
+  lab = rgb_to_lab(rgb)[..., numpy.newaxis, :]
+  distances = delta_e(lab, wool_lab[allowed])
+  return allowed[numpy.argmin(distances, axis=-1)]
+
+
+def shared_zeros(shape, dtype=numpy.uint8):
+  """Zeroed numpy array in shared memory, which processes forked afterwards
+  can write to."""
+  dtype = numpy.dtype(dtype)
+  size = int(numpy.prod(shape)) * dtype.itemsize
+  raw = multiprocessing.RawArray(ctypes.c_uint8, max(size, 1))
+  return numpy.frombuffer(raw, dtype, int(numpy.prod(shape))).reshape(shape)
+
+
+# Axes of the block arrays, in index order.
+_AXES = ('y', 'z', 'x')
+
+
 class Coord(object):
   def __init__(self, x, y, z):
     self.x = x
@@ -57,11 +158,71 @@ class Coord(object):
     return str(self)
 
 
+class NBTWriter(object):
+  """Streaming writer for the NBT format.
+
+  Tags are written to the file as soon as they are given, so large byte
+  arrays never need to be assembled in memory. Only the tags needed for
+  schematics are supported.
+  """
+
+  TAG_END = 0
+  TAG_SHORT = 2
+  TAG_INT = 3
+  TAG_BYTE_ARRAY = 7
+  TAG_STRING = 8
+  TAG_LIST = 9
+  TAG_COMPOUND = 10
+
+  def __init__(self, ofile):
+    self.ofile = ofile
+
+  def _header(self, tagtype, name):
+    name = name.encode('utf-8')
+    self.ofile.write(struct.pack('>bH', tagtype, len(name)) + name)
+
+  def start_compound(self, name):
+    self._header(self.TAG_COMPOUND, name)
+
+  def end_compound(self):
+    self.ofile.write(struct.pack('>b', self.TAG_END))
+
+  def write_string(self, name, value):
+    self._header(self.TAG_STRING, name)
+    value = value.encode('utf-8')
+    self.ofile.write(struct.pack('>H', len(value)) + value)
+
+  def write_short(self, name, value):
+    self._header(self.TAG_SHORT, name)
+    self.ofile.write(struct.pack('>h', value))
+
+  def write_int(self, name, value):
+    self._header(self.TAG_INT, name)
+    self.ofile.write(struct.pack('>i', value))
+
+  def write_empty_list(self, name, tagtype):
+    self._header(self.TAG_LIST, name)
+    self.ofile.write(struct.pack('>bi', tagtype, 0))
+
+  def write_byte_array(self, name, array):
+    """Write a numpy uint8 array, in C order.
+
+    The array can be any view: it is written one slice of its first axis at a
+    time, copying only slices which are not contiguous in memory.
+    """
+    self._header(self.TAG_BYTE_ARRAY, name)
+    self.ofile.write(struct.pack('>i', array.size))
+    for layer in array:
+      self.ofile.write(buffer(numpy.ascontiguousarray(layer)))
+
+
 class Schematic(object):
   """Manipulate a minecraft schematic"""
   
 
-  def __init__(self, sizex, sizey, sizez):
+  def __init__(self, sizex, sizey, sizez, shared=False):
+    """If shared is true, blocks are kept in shared memory, so that
+    processes forked afterwards can fill them."""
     # In Minecraft coordinates, y being vertical one.
     self.sizex = int(sizex)
     self.sizey = int(sizey)
@@ -69,9 +230,11 @@ class Schematic(object):
 
     self.center = None
 
-    # Ordered y,z,x - the x coordinate varies the fastest.
-    self._blocks = array.array('c', '\x00' * self.sizex * self.sizey * self.sizez)
-    self._data = array.array('c', '\x00' * self.sizex * self.sizey * self.sizez)
+    # Indexed y,z,x - the x coordinate varies the fastest.
+    shape = (self.sizey, self.sizez, self.sizex)
+    zeros = shared_zeros if shared else numpy.zeros
+    self._blocks = zeros(shape, numpy.uint8)
+    self._data = zeros(shape, numpy.uint8)
 
   def _conv_key(self, key):
     """Convert a key (x,y,z tuple) to a block index."""
@@ -89,11 +252,24 @@ class Schematic(object):
     assert y >= 0 and y < self.sizey
     assert z >= 0 and z < self.sizez, str(z)
 
-    return ((y * self.sizez) + z) * self.sizex + x
+    return y, z, x
+
+  def _check_bounds(self, x, y, z):
+    """Check that coordinates, either scalars or arrays, are valid."""
+    for values, size in ((x, self.sizex), (y, self.sizey), (z, self.sizez)):
+      values = numpy.asarray(values)
+      if values.size:
+        assert values.min() >= 0 and values.max() < size
+
+  def _write(self, idx, block, data):
+    if block is not None:
+      self._blocks[idx] = block
+    if data is not None:
+      self._data[idx] = data
 
   def __getitem__(self, key):
     idx = self._conv_key(key)
-    return self._blocks[idx], self._data[idx]
+    return int(self._blocks[idx]), int(self._data[idx])
 
   def __setitem__(self, key, value):
     idx = self._conv_key(key)
@@ -104,28 +280,101 @@ class Schematic(object):
     else:
       block, data = value
 
-    if block is not None:
-      self._blocks[idx] = chr(block)
-    if data is not None:
-      self._data[idx] = chr(data)
+    self._write(idx, block, data)
+
+  def fill_column(self, x, z, y_start, y_end, block, data=None):
+    """Set blocks from y_start to y_end (excluded) in the x, z column.
+
+    x and z can also be arrays, to fill many columns at once. A None block or
+    data is left untouched.
+    """
+    if y_start >= y_end:
+      return
+    self._check_bounds(x, [y_start, y_end-1], z)
+    self._write((slice(y_start, y_end), z, x), block, data)
+
+  def fill_box(self, start, end, block, data=None):
+    """Set all blocks from the start to the end (excluded) Coord."""
+    if start.x >= end.x or start.y >= end.y or start.z >= end.z:
+      return
+    self._check_bounds([start.x, end.x-1], [start.y, end.y-1],
+                       [start.z, end.z-1])
+    self._write((slice(start.y, end.y), slice(start.z, end.z),
+                 slice(start.x, end.x)), block, data)
+
+  def scatter(self, x, y, z, block, data=None):
+    """Set blocks at all the coordinates given as arrays.
+
+    block and data are either a single value or an array of values.
+    """
+    self._check_bounds(x, y, z)
+    self._write((y, z, x), block, data)
+
+  def mirror(self, axis):
+    """Mirror the schematic along the 'x', 'y' or 'z' axis.
+
+    No block is moved: arrays are replaced by reversed views, and actual
+    reordering happens only when the schematic is written.
+    """
+    flip = [slice(None)] * 3
+    flip[_AXES.index(axis)] = slice(None, None, -1)
+    self._blocks = self._blocks[tuple(flip)]
+    self._data = self._data[tuple(flip)]
+
+    if self.center:
+      center = Coord(self.center.x, self.center.y, self.center.z)
+      setattr(center, axis,
+              getattr(self, 'size' + axis) - getattr(self.center, axis))
+      self.center = center
 
   def mirrorz(self):
-    new_blocks = array.array('c')
-    new_data = array.array('c')
+    self.mirror('z')
+
+  def rotate(self, turns=1):
+    """Rotate by quarter turns around the vertical axis.
 
-    # Ordered y,z,x - the x coordinate varies the fastest.
-    for y in xrange(self.sizey):
-      for z in xrange(self.sizez-1, -1, -1):
-        idx = ((y * self.sizez) + z) * self.sizex
-        new_blocks.extend(self._blocks[idx:idx+self.sizex])
-        new_data.extend(self._data[idx:idx+self.sizex])
+    Rotation is counterclockwise when seen from above. Like mirror(), it only
+    changes the way arrays are viewed.
+    """
+    turns %= 4
+    self._blocks = numpy.rot90(self._blocks, turns, axes=(1, 2))
+    self._data = numpy.rot90(self._data, turns, axes=(1, 2))
 
-    self._blocks = new_blocks
-    self._data = new_data
+    for _ in xrange(turns):
+      if self.center:
+        self.center = Coord(self.center.z, self.center.y,
+                            self.sizex - self.center.x)
+      self.sizex, self.sizez = self.sizez, self.sizex
+
+  def write(self, filename, compresslevel=9):
+    """Write the schematic to a gzipped NBT file, streaming block data."""
+    ofile = gzip.GzipFile(filename, 'wb', compresslevel)
+    try:
+      self.write_nbt(NBTWriter(ofile))
+    finally:
+      ofile.close()
+
+  def write_nbt(self, writer):
+    """Write the schematic NBT structure with the given NBTWriter."""
+    writer.start_compound('Schematic')
+    writer.write_string('Materials', 'Alpha')
+
+    writer.write_empty_list('Entities', NBTWriter.TAG_COMPOUND)
+    writer.write_empty_list('TileEntities', NBTWriter.TAG_COMPOUND)
+
+    writer.write_short('Height', self.sizey)
+    writer.write_short('Width', self.sizex)
+    writer.write_short('Length', self.sizez)
 
     if self.center:
-      self.center = Coord(self.center.x, self.center.y, self.sizez - self.center.z)
-    
+      writer.write_int('WEOffsetX', -self.center.x)
+      writer.write_int('WEOffsetY', -self.center.y)
+      writer.write_int('WEOffsetZ', -self.center.z)
+
+    writer.write_byte_array('Blocks', self._blocks)
+    writer.write_byte_array('Data', self._data)
+    writer.end_compound()
+
   def build_nbt(self):
     nbtfile = nbt.NBTFile()
     nbtfile.name = "Schematic"
@@ -0,0 +1,207 @@
+# Wadcraft is a program converting Doom WAD levels to minecraft format.
+# (C) 2011 Pierre Palatin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Vectorized rasterization of glbsp subsectors.
+
+Subsectors are convex polygons with clockwise segments. Each one is drawn by
+tracing its segments, and then filling, for each x, the range between the
+bottom and the top segments. Everything is done on numpy arrays, for all
+subsectors at once.
+
+Alternatively, classify() finds the subsector of sample points by walking
+down the BSP tree, which gives exactly one subsector per point.
+"""
+
+
+import numpy
+
+
+def _ranges(counts):
+  """For each i, yield 0..counts[i]-1, concatenated in a single array."""
+  total = counts.sum()
+  return numpy.arange(total) - numpy.repeat(numpy.cumsum(counts) - counts,
+                                            counts)
+
+
+def _reduce(keys, values, ufunc):
+  """Reduce values having the same key. Returns sorted unique keys and the
+  corresponding reduced values."""
+  if not len(keys):
+    return keys, values
+  order = numpy.argsort(keys, kind='mergesort')
+  keys = keys[order]
+  values = values[order]
+  starts = numpy.flatnonzero(numpy.r_[True, keys[1:] != keys[:-1]])
+  return keys[starts], ufunc.reduceat(values, starts)
+
+
+def lines(x1, y1, x2, y2):
+  """Draw lines, like bresenham.line does, but for arrays of lines.
+
+  Returns:
+    (idx, x, y) arrays, with one entry per point. idx is the index of the
+    line of the point. Points are in the order bresenham.line yields them.
+  """
+  x1, y1, x2, y2 = [numpy.asarray(a, numpy.int64) for a in (x1, y1, x2, y2)]
+  xdiff = abs(x2 - x1)
+  ydiff = abs(y2 - y1)
+
+  # Lines are drawn along their major axis, from the lowest coordinate.
+  xmajor = xdiff >= ydiff
+  swap = numpy.where(xmajor, x1 > x2, y1 > y2)
+  x1, x2 = numpy.where(swap, x2, x1), numpy.where(swap, x1, x2)
+  y1, y2 = numpy.where(swap, y2, y1), numpy.where(swap, y1, y2)
+
+  major = numpy.where(xmajor, xdiff, ydiff)
+  minor = numpy.where(xmajor, y2 - y1, x2 - x1)
+  ratio = minor / numpy.maximum(major, 1).astype(numpy.float64)
+
+  counts = major + 1
+  idx = numpy.repeat(numpy.arange(len(x1)), counts)
+  step = _ranges(counts)
+  xmajor = xmajor[idx]
+  x1 = x1[idx]
+  y1 = y1[idx]
+  ratio = ratio[idx]
+
+  x = numpy.where(xmajor, x1 + step, (x1 + step * ratio).astype(numpy.int64))
+  y = numpy.where(xmajor, (y1 + step * ratio).astype(numpy.int64), y1 + step)
+  return idx, x, y
+
+
+def subsectors(x1, z1, x2, z2, top, owner, linedef):
+  """Rasterize subsectors described by their segments.
+
+  Args:
+    x1, z1, x2, z2: end points of segments, in pixels.
+    top: for each segment, whether it is on the top side of its subsector.
+    owner: subsector of each segment. Segments of a subsector must be
+      contiguous, and subsectors in increasing order.
+    linedef: linedef of each segment, -1 when it has none.
+
+  Returns:
+    (x, z, subsector, linedef) arrays, with one entry for each pixel covered
+    either by a subsector, or by a linedef; the other one is then -1. Entries
+    are in drawing order, subsector by subsector: traced linedefs first, then
+    the surface, column by column.
+  """
+  top = numpy.asarray(top, bool)
+  owner = numpy.asarray(owner, numpy.int64)
+  linedef = numpy.asarray(linedef, numpy.int64)
+
+  idx, x, z = lines(x1, z1, x2, z2)
+  point_owner = owner[idx]
+  point_top = top[idx]
+
+  # Limits of the surface of each subsector, for each x.
+  width = x.max() + 1 if len(x) else 1
+  key = point_owner * width + x
+  top_keys, z_top = _reduce(key[point_top], z[point_top], numpy.maximum)
+  bottom_keys, z_bottom = _reduce(key[~point_top], z[~point_top],
+                                  numpy.minimum)
+  keys = numpy.intersect1d(top_keys, bottom_keys, assume_unique=True)
+  z_top = z_top[numpy.searchsorted(top_keys, keys)]
+  z_bottom = z_bottom[numpy.searchsorted(bottom_keys, keys)]
+
+  # And fill it.
+  counts = numpy.maximum(z_top - z_bottom + 1, 0)
+  fill_keys = numpy.repeat(keys, counts)
+  fill_z = numpy.repeat(z_bottom, counts) + _ranges(counts)
+
+  traced = linedef[idx] != -1
+  count = traced.sum()
+  all_owner = numpy.concatenate((point_owner[traced], fill_keys // width))
+  # Within a subsector, traced linedefs come before the surface.
+  order = numpy.argsort(
+      numpy.concatenate((all_owner[:count] * 2, all_owner[count:] * 2 + 1)),
+      kind='mergesort')
+
+  nofill = numpy.full(count, -1, numpy.int64)
+  noline = numpy.full(len(fill_keys), -1, numpy.int64)
+  return (numpy.concatenate((x[traced], fill_keys % width))[order],
+          numpy.concatenate((z[traced], fill_z))[order],
+          numpy.concatenate((nofill, all_owner[count:]))[order],
+          numpy.concatenate((linedef[idx][traced], noline))[order])
+
+
+def classify(x, y, node_x, node_y, node_dx, node_dy, node_right, node_left):
+  """Find the subsector of points by walking down a BSP tree.
+
+  All points go down the tree together, one level per step.
+
+  Args:
+    x, y: coordinates of the points, in map units.
+    node_x, node_y, node_dx, node_dy: partition lines of the nodes.
+    node_right, node_left: children of the nodes; node index, or ~subsector
+      for subsectors. The root is the last node. Without nodes, everything
+      is in subsector 0.
+
+  Returns:
+    An array with the subsector of each point.
+  """
+  x = numpy.asarray(x, numpy.float64)
+  y = numpy.asarray(y, numpy.float64)
+  current = numpy.full(len(x), len(node_x) - 1, numpy.int64)
+  if not len(node_x):
+    return numpy.zeros(len(x), numpy.int64)
+
+  active = numpy.arange(len(x))
+  for _ in xrange(len(node_x) + 1):
+    if not len(active):
+      return ~current
+    node = current[active]
+    dx = x[active] - node_x[node]
+    dy = y[active] - node_y[node]
+    ndx = node_dx[node]
+    ndy = node_dy[node]
+    # Same test as R_PointOnSide in the Doom engine; true for the left side.
+    left = numpy.where(
+        ndx == 0, numpy.where(dx <= 0, ndy > 0, ndy < 0),
+        numpy.where(ndy == 0, numpy.where(dy <= 0, ndx < 0, ndx > 0),
+                    dy * ndx >= ndy * dx))
+    current[active] = numpy.where(left, node_left[node], node_right[node])
+    active = active[current[active] >= 0]
+  raise Exception('BSP tree has a cycle.')
+
+
+def inside(x, y, owner, first, count, x1, y1, x2, y2, tolerance=0.0):
+  """Tell whether points are inside convex polygons.
+
+  Args:
+    x, y: coordinates of the points.
+    owner: polygon of each point.
+    first, count: edges of polygon i are first[i]..first[i]+count[i]-1.
+    x1, y1, x2, y2: end points of the edges, clockwise.
+    tolerance: how far out of an edge a point can be, to account for
+      rounded vertices.
+
+  Returns:
+    A boolean array.
+  """
+  x = numpy.asarray(x, numpy.float64)
+  y = numpy.asarray(y, numpy.float64)
+  counts = count[owner]
+  point = numpy.repeat(numpy.arange(len(x)), counts)
+  edge = numpy.repeat(first[owner], counts) + _ranges(counts)
+  ex = (x2[edge] - x1[edge]).astype(numpy.float64)
+  ey = (y2[edge] - y1[edge]).astype(numpy.float64)
+  # Edges are clockwise, so the inside is on their right.
+  cross = ex * (y[point] - y1[edge]) - ey * (x[point] - x1[edge])
+  outside = cross > tolerance * numpy.hypot(ex, ey)
+  result = numpy.ones(len(x), bool)
+  result[point[outside]] = False
+  return result
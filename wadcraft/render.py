@@ -24,48 +24,353 @@ Keep in mind the following mapping for coordinates
 """
 
 
-import colorsys
+import hashlib
 import math
-import random
+import multiprocessing
 import sys
+import zlib
 
-from colormath import color_objects
+import numpy
 
-from wadcraft import bresenham
+from wadcraft import colorcache
 from wadcraft import minecraft
+from wadcraft import rasterize
 from wadcraft import wadlib
 from wadcraft import waddecode
 
 
-class Pixel(object):
-  def __init__(self, x, z):
-    self.x = x
-    self.z = z
-    self.sectors = set()
-    self.linedefs = set()
+class SparseLists(object):
+  """Lists of values attached to some pixels, stored in CSR form."""
+
+  def __init__(self, pixels, values):
+    """Build from (pixel index, value) pairs, sorted by pixel."""
+    self.pixels, starts = numpy.unique(pixels, return_index=True)
+    self.starts = numpy.append(starts, len(pixels))
+    self.values = values
+
+  def get(self, pixel):
+    idx = numpy.searchsorted(self.pixels, pixel)
+    if idx == len(self.pixels) or self.pixels[idx] != pixel:
+      return self.values[:0]
+    return self.values[self.starts[idx]:self.starts[idx+1]]
+
+  def intern(self, pixels):
+    """Give an id to each distinct list.
+
+    Returns:
+      (ids, lists): ids is an array with the list id of each given pixel,
+      lists the tuple of values of each id. Id 0 is the empty list.
+    """
+    lists = [()]
+    known = {(): 0}
+    list_ids = numpy.zeros(len(self.pixels), numpy.intp)
+    values = self.values.tolist()
+    starts = self.starts.tolist()
+    for i in xrange(len(self.pixels)):
+      values_tuple = tuple(values[starts[i]:starts[i+1]])
+      if values_tuple not in known:
+        known[values_tuple] = len(lists)
+        lists.append(values_tuple)
+      list_ids[i] = known[values_tuple]
+
+    if not len(self.pixels):
+      return numpy.zeros(len(pixels), numpy.intp), lists
+    idx = numpy.minimum(numpy.searchsorted(self.pixels, pixels),
+                        len(self.pixels) - 1)
+    ids = numpy.where(self.pixels[idx] == pixels, list_ids[idx], 0)
+    return ids, lists
+
+
+class Raster(object):
+  """Sectors and linedefs covering each pixel of a level.
+
+  Most pixels are covered by a single sector, which is kept in a dense grid.
+  Pixels on sector borders have their other sectors in an overflow table.
+  Linedefs cover few pixels, so they are stored as sparse lists.
+
+  Vars:
+    sector: (sizex, sizez) array of the lowest sector id covering each pixel,
+      -1 if none.
+  """
+
+  def __init__(self, sizex, sizez, x, z, sector, linedef):
+    """Build from the coverage returned by rasterize.subsectors."""
+    self.sizex = sizex
+    self.sizez = sizez
+    pixel = x * sizez + z
+
+    covered = sector != -1
+    pixels, sectors = self._pairs(pixel[covered], sector[covered])
+    first = numpy.r_[True, pixels[1:] != pixels[:-1]][:len(pixels)]
+    self.sector = numpy.full(sizex * sizez, -1, numpy.int32)
+    self.sector[pixels[first]] = sectors[first]
+    self.sector = self.sector.reshape(sizex, sizez)
+    self.overflow = SparseLists(pixels[~first], sectors[~first])
+
+    traced = linedef != -1
+    self._linedefs = SparseLists(*self._pairs(pixel[traced], linedef[traced]))
+
+  def _pairs(self, pixels, values):
+    """Remove duplicate (pixel, value) pairs, and sort them."""
+    count = values.max() + 1 if len(values) else 1
+    pairs = numpy.unique(pixels * count + values)
+    return pairs // count, pairs % count
+
+  def pixels(self):
+    """Returns (x, z) arrays of all pixels covered by something."""
+    covered = self.sector.ravel() != -1
+    covered[self._linedefs.pixels] = True
+    return numpy.divmod(numpy.flatnonzero(covered), self.sizez)
+
+  def signatures(self):
+    """Group pixels by the sectors and linedefs covering them.
+
+    Returns:
+      (x, z, signature, contents): x, z and signature are arrays with an
+      entry per covered pixel; signature indexes contents, a list of
+      (sector ids, linedef ids) tuples.
+    """
+    x, z = self.pixels()
+    pixel = x * self.sizez + z
+    overflow_ids, overflow_lists = self.overflow.intern(pixel)
+    linedef_ids, linedef_lists = self._linedefs.intern(pixel)
+
+    keys = numpy.column_stack(
+        (self.sector.ravel()[pixel], overflow_ids, linedef_ids))
+    if not len(keys):
+      return x, z, numpy.zeros(0, numpy.intp), []
+    keys, signature = numpy.unique(keys, axis=0, return_inverse=True)
+
+    contents = []
+    for primary, overflow_id, linedef_id in keys.tolist():
+      sectors = ()
+      if primary != -1:
+        sectors = (primary,) + overflow_lists[overflow_id]
+      contents.append((sectors, linedef_lists[linedef_id]))
+    return x, z, signature, contents
+
+  def sectors(self, x, z):
+    """Returns the ids of sectors covering the given pixel."""
+    primary = self.sector[x, z]
+    if primary == -1:
+      return []
+    return [primary] + self.overflow.get(x * self.sizez + z).tolist()
+
+  def linedefs(self, x, z):
+    """Returns the ids of linedefs covering the given pixel."""
+    return self._linedefs.get(x * self.sizez + z).tolist()
+
+
+class Column(object):
+  """Blocks of a pixel column, shared by all pixels with the same content.
+
+  Vars:
+    runs: [(y_start, y_end, block, data)], ranges of blocks, in drawing order.
+    floor: height of the floor, None for walls.
+    light: light level of the column, for torches.
+    torch: whether a torch can be placed on the floor.
+  """
+
+  def __init__(self):
+    self.runs = []
     self.floor = None
+    self.light = 0
+    self.torch = False
 
+  def add(self, y_start, y_end, block, data):
+    if y_start < y_end:
+      self.runs.append((y_start, y_end, block, data))
 
-class Raster(dict):
-  def __getitem__(self, key):
-    return self.setdefault(key, Pixel(*key))
+
+# Identifies how graphics are mapped to wools, as part of color cache keys.
+# Change it whenever ColorMapper._graphic_color changes its results.
+_COLOR_METRIC = 'mean/cie2000/v1'
+
+
+# Ways to turn subsectors into pixels; see Render._rasterize.
+RASTER_ENGINES = ('polygons', 'bsp')
+
+
+# Patterns deciding where torches go; see _torch_noise.
+TORCH_PATTERNS = ('hash', 'blue')
+
+
+def _hash_noise(*keys):
+  """Stateless hash of integer arrays, broadcast together, to floats in
+  [0, 1). Uses the splitmix64 mixing function."""
+  keys = numpy.broadcast_arrays(*[numpy.asarray(k, numpy.int64)
+                                  for k in keys])
+  h = numpy.zeros(keys[0].shape, numpy.uint64)
+  for key in keys:
+    h ^= key.astype(numpy.uint64)
+    h += numpy.uint64(0x9e3779b97f4a7c15)
+    h ^= h >> numpy.uint64(30)
+    h *= numpy.uint64(0xbf58476d1ce4e5b9)
+    h ^= h >> numpy.uint64(27)
+    h *= numpy.uint64(0x94d049bb133111eb)
+    h ^= h >> numpy.uint64(31)
+  return (h >> numpy.uint64(11)).astype(numpy.float64) / 2.0**53
+
+
+def _torch_noise(pattern, level, x, z, light):
+  """Threshold deciding whether pixels get a torch, in [0, 1).
+
+  It only depends on its arguments, so pixels can be rendered in any order
+  or subset. 'hash' is white noise over (level, x, z, light). 'blue' is
+  interleaved gradient noise, offset per level: torches are then spread
+  more evenly, without clumps.
+  """
+  seed = zlib.crc32(level) & 0xffffffff
+  if pattern == 'blue':
+    offset_x, offset_z = divmod(seed, 1 << 16)
+    value = 0.06711056 * (x + offset_x) + 0.00583715 * (z + offset_z)
+    return numpy.modf(52.9829189 * numpy.modf(value)[0])[0]
+  return _hash_noise(seed, x, z, light)
+
+
+# Render whose tiles are drawn by the worker processes. Workers are forked
+# once it is set, so they share it read-only.
+_tile_renderer = None
+
+
+def _render_tile(args):
+  """Worker side of Render._render_tiles."""
+  engine, tile = args
+  # Only send back the colors this tile added.
+  _tile_renderer.colors.new = {}
+  _tile_renderer._render_tile(engine, tile)
+  return _tile_renderer.colors.new
+
+
+# What the level worker processes need: (wad, callback, color_cache,
+# options). Like _tile_renderer, it is set before workers are forked.
+_level_batch = None
+
+
+def _render_batch_level(levelname):
+  """Worker side of render_levels."""
+  wad, callback, color_cache, options = _level_batch
+  renderer = _render_one(wad, levelname, callback, color_cache, options)
+  return levelname, renderer.colors.new
+
+
+def _render_one(wad, levelname, callback, color_cache, options):
+  rotate, engine, torch_pattern = options
+  print 'Converting level %s ...' % levelname
+  renderer = Render(wad, wad.rawwad.levelindex[levelname], color_cache,
+                    engine, 1, torch_pattern)
+  renderer.schematic.rotate(rotate)
+  callback(levelname, renderer.schematic)
+  return renderer
+
+
+class ColorMapper(object):
+  """Picks the wool colors of the flats and textures of a wad.
+
+  Colors are looked up in a ColorCache first; the ones it did not have are
+  also recorded in new.
+  """
+
+  def __init__(self, wad, cache=None):
+    self.wad = wad
+    if cache is None:
+      cache = colorcache.ColorCache()
+    self.cache = cache
+    self.new = {}
+    self._flats = {}
+    self._textures = {}
+    self._patch_digests = {}
+    # Black wool makes things really hard to see.
+    self._wool_exclude = (0xf,)
+    self._key = self._get_key()
+
+  def resolve(self, flat_names, texture_names):
+    """Compute the colors of the given flats and textures, when they
+    exist."""
+    for name in flat_names:
+      flat = self.wad.flats.get(name)
+      if flat is not None:
+        self.flat(flat)
+    for name in texture_names:
+      if name in self.wad.textures:
+        self.texture(name)
+
+  def _graphic_color(self, counts, transparent):
+    """From the palette histogram of a graphic, returns which wool color is
+    supposed to be used."""
+    mean, _, _ = waddecode.colorstats(counts, transparent,
+                                      self.wad.playpal.palettes[0])
+    return int(minecraft.nearest_wool(mean, self._wool_exclude))
+
+  def _get_key(self):
+    """Hash of what, besides graphics, decides their color."""
+    digest = hashlib.sha1(_COLOR_METRIC)
+    digest.update(repr(self._wool_exclude))
+    digest.update(self.wad.playpal.palettes[0][:, :3].tostring())
+    return digest.hexdigest()
+
+  def _patch_digest(self, patch):
+    if not patch in self._patch_digests:
+      self._patch_digests[patch] = hashlib.sha1(patch.data).hexdigest()
+    return self._patch_digests[patch]
+
+  def _cached(self, key, name, compute):
+    """Returns the color from the color cache, or compute() and caches it."""
+    key = hashlib.sha1(self._key + key).hexdigest()
+    color = self.cache.get(key)
+    if color is None:
+      print '   Mapping %s ...' % name
+      color = compute()
+      self.cache.put(key, color)
+      self.new[key] = color
+    return color
+
+  def flat(self, flat):
+    """Wool color of a flat."""
+    if not flat in self._flats:
+      key = 'flat:' + hashlib.sha1(flat.data).hexdigest()
+      self._flats[flat] = self._cached(
+          key, 'flat %s' % flat.name,
+          lambda: self._graphic_color(
+              *self.wad.rawwad.flathistogram(flat)))
+    return self._flats[flat]
+
+  def texture(self, texture):
+    """Wool color of a texture, by name."""
+    if not texture in self._textures:
+      texdef = self.wad.textures.get(texture, None)
+      if not texdef:
+        print '   Unable to find texture', texture
+        color = 0
+      else:  
+        # The texture name does not matter, only its size and patches.
+        key = ['texture:%d,%d' % (texdef[3], texdef[4])]
+        for patchdef in texdef[-1]:
+          patch = self.wad.patchdict[patchdef[2]]
+          key.append('%d,%d,%s' % (patchdef[0], patchdef[1],
+                                   self._patch_digest(patch)))
+        color = self._cached(
+            ';'.join(key), 'texture %s' % texture,
+            lambda: self._graphic_color(
+                *self.wad.rawwad.texturehistogram(texdef,
+                                                  self.wad.patchdict)))
+      self._textures[texture] = color
+    return self._textures[texture]
 
 
 class Render(wadlib.Level):
-  def __init__(self, wad, rawlevel):
+  def __init__(self, wad, rawlevel, color_cache=None, engine='polygons',
+               workers=1, torch_pattern='hash'):
     super(Render, self).__init__(wad, rawlevel)
 
-    self._flat_colors = {}
-    self._texture_colors = {}
+    self.colors = ColorMapper(self.wad, color_cache)
+    self._torch_pattern = torch_pattern
 
     self._compute_transform()
-    self._init_schematic()
-  
-    self.raster = Raster()
-    for subsector in self.subsectors:
-      self._rasterize_subsector(subsector)
+    self._init_schematic(shared=workers > 1)
+    self._prepare_segments()
 
-    self._render_raster()
+    self._render_tiles(engine, workers)
 
     self._set_center()
 
@@ -109,144 +414,231 @@ class Render(wadlib.Level):
     assert self.tr(self.bbox1).z >= 0.0
     assert self.tr(self.min_height).y >= 0.0
     
-  def _init_schematic(self):
+  def _init_schematic(self, shared=False):
     # Create the map. The +1 for the size is because we're actually actually
     # calculating the coordinates of the most extreme point.
     sizex = math.ceil(self.tr(self.bbox2).x)+1
     sizey = math.ceil(self.tr(self.max_height).y)+2
     sizez = math.ceil(self.tr(self.bbox2).z)+1
 
-    self.schematic = minecraft.Schematic(sizex, sizey, sizez)
+    self.schematic = minecraft.Schematic(sizex, sizey, sizez, shared)
+
+    # Floor height of open pixels.
+    zeros = minecraft.shared_zeros if shared else numpy.zeros
+    self.floor = zeros((self.schematic.sizex, self.schematic.sizez),
+                       numpy.int32)
 
     print 'Size:', sizex, sizey, sizez
 
-  def _rasterize_subsector(self, ssector):
-    """Transform the given subsector into a serie of pixels.
+  def _prepare_segments(self):
+    """Segments of all subsectors in subsector order, in pixels."""
+    counts = self.subsector_count
+    owner = numpy.repeat(numpy.arange(len(counts)), counts)
+    seg_idx = (numpy.repeat(self.subsector_first - (numpy.cumsum(counts) -
+                                                    counts), counts) +
+               numpy.arange(len(owner)))
+    v1 = self.segment_v1[seg_idx]
+    v2 = self.segment_v2[seg_idx]
+
+    coord_x = ((self.vertex_x.astype(numpy.float64) + self.transx) *
+               self.scalex).astype(numpy.int64)
+    coord_z = ((self.vertex_y.astype(numpy.float64) + self.transz) *
+               self.scalez).astype(numpy.int64)
+
+    self._seg_owner = owner
+    self._seg_x1 = coord_x[v1]
+    self._seg_z1 = coord_z[v1]
+    self._seg_x2 = coord_x[v2]
+    self._seg_z2 = coord_z[v2]
+    # Segments are clockwise, so we know if this is a top or bottom segment.
+    self._seg_top = self.vertex_x[v2] >= self.vertex_x[v1]
+    self._seg_linedef = numpy.where(self.segment_sidedef[seg_idx] != -1,
+                                    self.segment_linedef[seg_idx], -1)
+
+    # Pixel bounding box of each subsector, to find the ones of a tile.
+    inf = numpy.iinfo(numpy.int64)
+    self._ssect_min_x = numpy.full(len(counts), inf.max, numpy.int64)
+    self._ssect_min_z = numpy.full(len(counts), inf.max, numpy.int64)
+    self._ssect_max_x = numpy.full(len(counts), inf.min, numpy.int64)
+    self._ssect_max_z = numpy.full(len(counts), inf.min, numpy.int64)
+    for bound, ufunc, a, b in (
+        (self._ssect_min_x, numpy.minimum, self._seg_x1, self._seg_x2),
+        (self._ssect_min_z, numpy.minimum, self._seg_z1, self._seg_z2),
+        (self._ssect_max_x, numpy.maximum, self._seg_x1, self._seg_x2),
+        (self._ssect_max_z, numpy.maximum, self._seg_z1, self._seg_z2)):
+      ufunc.at(bound, owner, ufunc(a, b))
+
+  def _rasterize(self, engine, tile):
+    """Transform the subsectors of a tile into a raster of pixels.
 
     A pixel contains all sectors and linedefs covering this pixel, for later
-    rendering.
+    rendering. With the 'polygons' engine, each subsector is drawn on its
+    own. With the 'bsp' engine, the center of each pixel is classified
+    through the BSP tree instead, so a pixel gets a single surface.
+
+    The tile is (x0, z0, x1, z1), x1 and z1 excluded; the raster is in tile
+    coordinates.
     """
-    z_top = {}
-    z_bottom = {}
-    border = {}
-
-    for seg in ssector.segments:
-      # Shamelessly modify segments data to add our own coordinates
-      seg.coord_start = self.tr(seg.vertex_start)
-      seg.coord_end = self.tr(seg.vertex_end)
-
-      # Segments are clockwise, so we know if this is a top or bottom segment.
-      top_seg = (seg.vertex_end.x >= seg.vertex_start.x)
-
-      # And then draw the segment
-      gen_line = bresenham.line(seg.coord_start.x, seg.coord_start.z,
-                                seg.coord_end.x, seg.coord_end.z)
-      for x, z in gen_line:
-        if seg.sidedef:
-          self.raster[x, z].linedefs.add(seg.linedef)
-        
-        # Keep track of the segment to fill the surface afterwards
-        if top_seg:
-          z_top[x] = max(z_top.get(x, z), z)
-        else:
-          z_bottom[x] = min(z_bottom.get(x, z), z)
-
-    # We're done with all segment, so we now know the limits of the surface, so
-    # draw it.
-    assert len(z_top) == len(z_bottom)
-    for x in sorted(z_top.iterkeys()):
-      for z in xrange(z_bottom[x], z_top[x]+1):
-        self.raster[x, z].sectors.add(ssector.sector)
-
-  def _get_graphic_color(self, graphic):
-    """From a flat definition, returns which wool color is supposed to be used."""
-    width, height, image = waddecode.indexed2rgba(graphic, self.wad.playpal.palettes[0])
-    r = g = b = 0
-    for y in xrange(0, height):
-      for x in xrange(0, width):
-        idx = (x + y * width) * 4
-        r += ord(image[idx])
-        g += ord(image[idx+1])
-        b += ord(image[idx+2])
-
-    r = r / (width * height)
-    g = g / (width * height)
-    b = b / (width * height)
-
-    color = color_objects.RGBColor(r, g, b)
-
-    min_idx = 0
-    min_dist = sys.maxint
-    for idx, w_color in minecraft.wool_colors.iteritems():
-      # Exclude black wool, as it makes things really hard to see
-      if idx == 0xf:
-        continue
-      dist = color.delta_e(w_color)
-      if dist < min_dist:
-        min_idx = idx
-        min_dist = dist
+    x0, z0, x1, z1 = tile
+    touching = ((self._ssect_min_x < x1) & (self._ssect_max_x >= x0) &
+                (self._ssect_min_z < z1) & (self._ssect_max_z >= z0))
+    selected = touching[self._seg_owner]
+    segments = (self._seg_x1[selected], self._seg_z1[selected],
+                self._seg_x2[selected], self._seg_z2[selected])
+    owner = self._seg_owner[selected]
+    linedef = self._seg_linedef[selected]
+
+    if engine == 'bsp':
+      x, z, ssect, linedef = self._classify_pixels(tile, owner, linedef,
+                                                   *segments)
+    else:
+      x, z, ssect, linedef = rasterize.subsectors(
+          *(segments + (self._seg_top[selected], owner, linedef)))
+    sector = numpy.where(ssect != -1, self.subsector_sector[ssect], -1)
 
-    return min_idx
+    keep = (x >= x0) & (x < x1) & (z >= z0) & (z < z1)
+    return Raster(x1 - x0, z1 - z0, x[keep] - x0, z[keep] - z0, sector[keep],
+                  linedef[keep])
 
-  def _get_flat_color(self, flat):
-    if not flat in self._flat_colors:
-      print '   Mapping flat %s ...' % flat.name
-      self._flat_colors[flat] = self._get_graphic_color(flat.getgraphic())
-    return self._flat_colors[flat]
+  def _classify_pixels(self, tile, owner, linedef, x1, z1, x2, z2):
+    """Coverage of the 'bsp' engine, in the format of rasterize.subsectors.
 
-  def _get_texture_color(self, texture):
-    if not texture in self._texture_colors:
-      texdef = self.wad.textures.get(texture, None)
-      if not texdef:
-        print '   Unable to find texture', texture
-        color = 0
-      else:  
-        print '   Mapping texture %s ...' % texture
-        g = waddecode.buildtexture(
-          texdef,
-          self.wad.patchdict)
-        color = self._get_graphic_color(g)
-      self._texture_colors[texture] = color
-    return self._texture_colors[texture]
+    Linedefs are traced like with polygons, along with the subsector of
+    their segment, so that walls know their sectors. Pixel centers outside
+    of their subsector are outside of the level.
+    """
+    tile_x0, tile_z0, tile_x1, tile_z1 = tile
+    sizez = tile_z1 - tile_z0
+    px, pz = numpy.divmod(numpy.arange((tile_x1 - tile_x0) * sizez), sizez)
+    px += tile_x0
+    pz += tile_z0
+    map_x = (px + 0.5) / self.scalex - self.transx
+    map_y = (pz + 0.5) / self.scalez - self.transz
+    ssect = rasterize.classify(map_x, map_y, self.node_x, self.node_y,
+                               self.node_dx, self.node_dy, self.node_right,
+                               self.node_left)
+    keep = rasterize.inside(
+        map_x, map_y, ssect, self.subsector_first, self.subsector_count,
+        self.vertex_x[self.segment_v1], self.vertex_y[self.segment_v1],
+        self.vertex_x[self.segment_v2], self.vertex_y[self.segment_v2],
+        tolerance=1.0)
+
+    traced = linedef != -1
+    idx, x, z = rasterize.lines(x1[traced], z1[traced], x2[traced],
+                                z2[traced])
+    ssect_traced = owner[traced][idx]
+    nofill = numpy.full(len(idx), -1, numpy.int64)
+    noline = numpy.full(keep.sum() + len(idx), -1, numpy.int64)
+    return (numpy.concatenate((px[keep], x, x)),
+            numpy.concatenate((pz[keep], z, z)),
+            numpy.concatenate((ssect[keep], ssect_traced, nofill)),
+            numpy.concatenate((noline, linedef[traced][idx])))
+
+  def _tiles(self, workers):
+    """Split the level in tiles, a few per worker to balance the load."""
+    sizex = self.schematic.sizex
+    sizez = self.schematic.sizez
+    if workers <= 1:
+      return [(0, 0, sizex, sizez)]
+    side = max(16, int(math.ceil(math.sqrt(sizex * sizez / (4.0 * workers)))))
+    return [(x, z, min(x + side, sizex), min(z + side, sizez))
+            for x in xrange(0, sizex, side) for z in xrange(0, sizez, side)]
+
+  def _render_tiles(self, engine, workers):
+    """Render all tiles, in worker processes if there are several workers.
+
+    Workers fill the shared schematic and floor arrays in place.
+    """
+    global _tile_renderer
+    tiles = self._tiles(workers)
+    if workers > 1:
+      # Otherwise each worker would compute them again.
+      self.colors.resolve(self.flat_names, self.texture_names)
+      _tile_renderer = self
+      pool = multiprocessing.Pool(workers)
+      try:
+        results = pool.map(_render_tile, [(engine, t) for t in tiles])
+      finally:
+        pool.close()
+        pool.join()
+        _tile_renderer = None
+      for new_colors in results:
+        for key, color in new_colors.iteritems():
+          self.colors.cache.put(key, color)
+          self.colors.new[key] = color
+    else:
+      for tile in tiles:
+        self._render_tile(engine, tile)
 
-  def _render_raster(self):
-    for pixel in self.raster.itervalues():
-      self._render_pixel(pixel)
+  def _render_tile(self, engine, tile):
+    """Render all pixels of a tile.
 
-  def _render_pixel(self, pixel):
-    """Render the given pixel to a column of cubes.
+    Pixels covered by the same sectors and linedefs render to the same column
+    of blocks, so each distinct column is computed only once. Torches are
+    then decided pixel by pixel.
+    """
+    x, z, signatures, contents = self._rasterize(engine, tile).signatures()
+    x += tile[0]
+    z += tile[1]
+    columns = [self._render_column(sectors, linedefs)
+               for sectors, linedefs in contents]
+
+    # Stamp each column on all its pixels at once.
+    order = numpy.argsort(signatures, kind='mergesort')
+    bounds = numpy.searchsorted(signatures[order],
+                                numpy.arange(len(columns)+1))
+    for i, column in enumerate(columns):
+      pixels = order[bounds[i]:bounds[i+1]]
+      for y_start, y_end, block, data in column.runs:
+        self.schematic.fill_column(x[pixels], z[pixels], y_start, y_end,
+                                   block, data)
+
+    # Walls have no floor, and no torches.
+    is_open = numpy.array([c.floor is not None for c in columns],
+                          bool)[signatures]
+    x, z, signatures = x[is_open], z[is_open], signatures[is_open]
+    floors = numpy.array([c.floor or 0 for c in columns],
+                         numpy.int32)[signatures]
+    self.floor[x, z] = floors
+
+    ## Add torches for light level
+    lights = numpy.array([c.light for c in columns], numpy.int32)[signatures]
+    torches = numpy.array([c.torch for c in columns], bool)[signatures]
+
+    draws = _torch_noise(self._torch_pattern, self.rawlevel.header.name,
+                         x, z, lights)
+    has_light = draws < ((lights / 255.0) / 10.0)
+    torches &= has_light
+    self.schematic.scatter(x[torches], floors[torches]+1, z[torches], 0x32)
+
+  def _render_column(self, sector_ids, linedef_ids):
+    """Render a pixel covered by the given sectors and linedefs to a column.
 
     It can either be rendered as a wall (single middle texture), or an open
     area, with floor, ceiling and potentially lower and higher texture.
     """
-    wall = False
+    linedefs = [self.linedefs[i] for i in linedef_ids]
+    column = Column()
 
-    # Check ceiling and floor limits.
+    # Check ceiling and floor limits. Doors are considered open, with the
+    # ceiling of their highest neighbor.
     floor_high = ceil_high = -sys.maxint
     floor_low = ceil_low = sys.maxint
 
-    pixel.floor_sector = None
-    pixel.ceil_sector = None
-
-    for sector in pixel.sectors:
-      floor = sector.floor
-      ceiling = sector.ceiling
-      if floor == ceiling:
-        # Consider door to be open, so we need to find height of adjecent
-        # sector.
-        for sidedef in sector.sidedefs:
-          if not sidedef.partner:
-            continue
-          ceiling = max(ceiling, sidedef.partner.sector.ceiling)
-    
+    floor_sector = None
+    ceil_sector = None
+
+    for sector in sector_ids:
+      floor = int(self.sector_floor[sector])
+      ceiling = int(self.sector_open_ceiling[sector])
       if floor > floor_high:
-        pixel.floor_sector = sector
+        floor_sector = sector
         floor_high = floor
       floor_low = min(floor_low, floor)
 
       ceil_high = max(ceil_high, ceiling)
       if ceiling < ceil_low:
-        pixel.ceil_sector = sector
+        ceil_sector = sector
         ceil_low = ceiling
 
     # Convert to minecraft coordinates
@@ -257,7 +649,7 @@ class Render(wadlib.Level):
 
     # If one of the linedef on this pixel is onesided, we need to have a full
     # wall; otherwise we might have gaps in the rendering.
-    onesided = [l for l in pixel.linedefs if l.onesided]
+    onesided = [l for l in linedefs if l.onesided]
     if onesided:
       ## Render wall
       # Pick one of the onesided wall texture; pick the one with the biggest
@@ -271,85 +663,69 @@ class Render(wadlib.Level):
           max_size = size
           max_side = side
 
-      color = self._get_texture_color(max_side.middle_texture)
+      color = self.colors.texture(max_side.middle_texture)
 
-      for y in xrange(int(floor_low), int(ceil_high)+1):
-        self.schematic[pixel.x, y, pixel.z] = (0x23, color)
-    else:
-      lightlevel = max([s.light for s in pixel.sectors])
-      has_light = random.random() < ((lightlevel / 255.0) / 10.0)
-
-      pixel.floor = int(floor_high)
-      pixel.ceiling = int(ceil_low)
-
-      ## Render floor
-      floor_flat = pixel.floor_sector.floor_flat
-      floor_color = self._get_flat_color(floor_flat)
-
-      sidedef = None
-      for linedef in pixel.linedefs:
-        # They are all double sided at this point  
-        if linedef.left.sector == pixel.floor_sector:
-          sidedef = linedef.left
-        if linedef.right.sector == pixel.floor_sector:
-          sidedef = linedef.right
-        if sidedef and not sidedef.lower_texture:
-          sidedef = None
-
-      if sidedef:
-        lower_color = self._get_texture_color(sidedef.lower_texture)
-      else:
-        lower_color = 0
-
-      self.schematic[pixel.x, pixel.floor, pixel.z] = (0x23, floor_color)
-      for y in xrange(int(floor_low), pixel.floor):
-        self.schematic[pixel.x, y, pixel.z] = (0x23, lower_color)
-
-      ## Render ceiling
-      ceil_flat = pixel.ceil_sector.ceil_flat
-      skylight = 'sky' in ceil_flat.name.lower()
-      if not skylight:
-        # Draw only when it's not a sky texture
-        sidedef = None
-        for linedef in pixel.linedefs:
-          # They are all double sided at this point  
-          if linedef.left.sector == pixel.ceil_sector:
-            sidedef = linedef.left
-          if linedef.right.sector == pixel.ceil_sector:
-            sidedef = linedef.right
-          if sidedef and not sidedef.upper_texture:
-            sidedef = None
-
-        if sidedef:
-          upper_color = self._get_texture_color(sidedef.upper_texture)
-        else:
-          upper_color = 0
-
-        ceil_color = self._get_flat_color(ceil_flat)
-        self.schematic[pixel.x, pixel.ceiling, pixel.z] = (0x23, ceil_color)
-        for y in xrange(pixel.ceiling+1, int(ceil_high)+1):
-          self.schematic[pixel.x, y, pixel.z] = (0x23, upper_color)
-
-      ## Render room level if needed
-      # We want to fill with glass if impassable and textured
-      glass = False
-      for linedef in pixel.linedefs:
-        if not linedef.flag_block_player:
-          continue
-        # We know that all linedefs have 2 sidedefs here, otherwise it would
-        # have been drawn as a wall.
-        if linedef.left.middle_texture or linedef.right.middle_texture:
-          glass = True
-          break
-
-      if glass:
-        for y in xrange(pixel.floor+1, pixel.ceiling):
-          self.schematic[pixel.x, y, pixel.z] = (0x14, 0)
-      
-      ## Add torches for light level
-      if has_light and not skylight and not glass:
-        self.schematic[pixel.x, pixel.floor+1, pixel.z] = 0x32
+      column.add(int(floor_low), int(ceil_high)+1, 0x23, color)
+      return column
+
+    column.light = int(self.sector_light[list(sector_ids)].max())
+    column.floor = floor_y = int(floor_high)
+    ceil_y = int(ceil_low)
+
+    ## Render floor
+    floor_color = self.colors.flat(self.sectors[floor_sector].floor_flat)
+    lower = self._side_texture(linedef_ids, floor_sector, self.sidedef_lower)
+    lower_color = self.colors.texture(lower) if lower else 0
+
+    column.add(floor_y, floor_y+1, 0x23, floor_color)
+    column.add(int(floor_low), floor_y, 0x23, lower_color)
 
+    ## Render ceiling
+    skylight = self.sector_sky[ceil_sector]
+    if not skylight:
+      # Draw only when it's not a sky texture
+      upper = self._side_texture(linedef_ids, ceil_sector, self.sidedef_upper)
+      upper_color = self.colors.texture(upper) if upper else 0
+
+      ceil_color = self.colors.flat(self.sectors[ceil_sector].ceil_flat)
+      column.add(ceil_y, ceil_y+1, 0x23, ceil_color)
+      column.add(ceil_y+1, int(ceil_high)+1, 0x23, upper_color)
+
+    ## Render room level if needed
+    # We want to fill with glass if impassable and textured
+    glass = False
+    for linedef in linedefs:
+      if not linedef.flag_block_player:
+        continue
+      # We know that all linedefs have 2 sidedefs here, otherwise it would
+      # have been drawn as a wall.
+      if linedef.left.middle_texture or linedef.right.middle_texture:
+        glass = True
+        break
+
+    if glass:
+      column.add(floor_y+1, ceil_y, 0x14, 0)
+
+    column.torch = not skylight and not glass
+    return column
+
+  def _side_texture(self, linedef_ids, sector, textures):
+    """Name of the texture to use for a step of the given sector.
+
+    The last of the pixel linedefs with a side in the sector decides, with
+    that side texture, or none. All linedefs are double sided here.
+    """
+    texture = -1
+    for linedef in linedef_ids:
+      right = self.linedef_right[linedef]
+      left = self.linedef_left[linedef]
+      if right != -1 and self.sidedef_sector[right] == sector:
+        texture = textures[right]
+      elif left != -1 and self.sidedef_sector[left] == sector:
+        texture = textures[left]
+    if texture == -1:
+      return None
+    return self.texture_names[texture]
 
   def _set_center(self):
     player = None
@@ -359,11 +735,53 @@ class Render(wadlib.Level):
         player = t
 
     coords = self.tr(wadlib.Vertex(player.x, player.y))
-    pixel = self.raster[coords.x, coords.z]
-    self.schematic.center = minecraft.Coord(coords.x, pixel.floor+1, coords.z)
-
-
-def render_level(wad, rawlevel):
-  renderer = Render(wad, rawlevel)
-  nbtfile = renderer.schematic.build_nbt()
-  return nbtfile
+    floor = int(self.floor[coords.x, coords.z])
+    self.schematic.center = minecraft.Coord(coords.x, floor+1, coords.z)
+
+
+def render_level(wad, rawlevel, rotate=0, color_cache=None,
+                 engine='polygons', workers=1, torch_pattern='hash'):
+  renderer = Render(wad, rawlevel, color_cache, engine, workers,
+                    torch_pattern)
+  renderer.schematic.rotate(rotate)
+  return renderer.schematic
+
+
+def render_levels(wad, levelnames, callback, rotate=0, color_cache=None,
+                  engine='polygons', workers=1, torch_pattern='hash'):
+  """Render several levels of a wad, using workers processes.
+
+  Each worker renders whole levels, one at a time, with the wad and its
+  caches inherited from this process. The colors of all flats and textures
+  of the levels are computed before the workers are forked, so that they do
+  not each decode the same graphics. callback(levelname, schematic) is
+  called for each level, in the process which rendered it, so schematics
+  never have to be sent back.
+  """
+  global _level_batch
+  if color_cache is None:
+    color_cache = colorcache.ColorCache()
+  options = (rotate, engine, torch_pattern)
+
+  if workers <= 1 or len(levelnames) <= 1:
+    for levelname in levelnames:
+      _render_one(wad, levelname, callback, color_cache, options)
+    return
+
+  colors = ColorMapper(wad, color_cache)
+  for levelname in levelnames:
+    level = wadlib.Level(wad, wad.rawwad.levelindex[levelname])
+    colors.resolve(level.flat_names, level.texture_names)
+
+  _level_batch = (wad, callback, color_cache, options)
+  pool = multiprocessing.Pool(min(workers, len(levelnames)))
+  try:
+    # Workers only update their own copy of the color cache.
+    for levelname, new_colors in pool.imap_unordered(_render_batch_level,
+                                                     levelnames):
+      for key, color in new_colors.iteritems():
+        color_cache.put(key, color)
+  finally:
+    pool.close()
+    pool.join()
+    _level_batch = None
@@ -0,0 +1,71 @@
+# Wadcraft is a program converting Doom WAD levels to minecraft format.
+# (C) 2011 Pierre Palatin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+import unittest
+
+import numpy
+
+from wadcraft import render
+from wadcraft import testwad
+
+
+class RasterTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.wad = testwad.load()
+    cls.rawlevel = cls.wad.rawwad.levelindex['MAP01']
+
+  def render(self, engine):
+    return render.render_level(self.wad, self.rawlevel, engine=engine)
+
+  def test_engines_match(self):
+    # On a map with axis aligned subsectors, the pixel centers of the bsp
+    # engine are exactly the pixels the polygons cover.
+    polygons = self.render('polygons')
+    bsp = self.render('bsp')
+    self.assertTrue(polygons._blocks.any())
+    numpy.testing.assert_array_equal(polygons._blocks, bsp._blocks)
+    numpy.testing.assert_array_equal(polygons._data, bsp._data)
+    self.assertEqual(repr(polygons.center), repr(bsp.center))
+
+class TorchNoiseTest(unittest.TestCase):
+
+  def test_stateless(self):
+    x, z = numpy.divmod(numpy.arange(400), 20)
+    light = numpy.full(400, 160)
+    for pattern in render.TORCH_PATTERNS:
+      noise = render._torch_noise(pattern, 'MAP01', x, z, light)
+      self.assertTrue(((noise >= 0) & (noise < 1)).all())
+      # Any subset, in any order, gets the same values.
+      subset = numpy.arange(399, 0, -7)
+      numpy.testing.assert_array_equal(
+          render._torch_noise(pattern, 'MAP01', x[subset], z[subset],
+                              light[subset]),
+          noise[subset])
+      self.assertFalse((render._torch_noise(pattern, 'MAP02', x, z, light)
+                        == noise).all())
+
+  def test_hash_spread(self):
+    noise = render._hash_noise(numpy.arange(10000))
+    self.assertEqual(len(numpy.unique(noise)), 10000)
+    self.assertAlmostEqual(noise.mean(), 0.5, places=1)
+
+
+if __name__ == '__main__':
+  unittest.main()
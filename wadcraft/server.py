@@ -0,0 +1,361 @@
+# Wadcraft is a program converting Doom WAD levels to minecraft format.
+# (C) 2011 Pierre Palatin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+"""HTTP conversion server, keeping wads loaded between conversions.
+
+IWADs are loaded once, when the server starts. GET /iwads lists them with
+their levels. Conversion jobs are POSTed to /convert, as a JSON object:
+
+  iwad: file name of one of the served IWADs, e.g. "doom2.wad".
+  level: name of the level to convert.
+  pwads: optional list of PWAD file names, relative to the directory given
+    with --pwad-dir. Without it, only pwad_data can be used.
+  pwad_data: optional list of base64 encoded PWADs, merged after pwads.
+    Their levels need GL nodes built into the wad (glbsp -v5 -o out.wad),
+    as they have no companion GWA file.
+  rotate, raster, torch_pattern, compress_level: same as the command line
+    options.
+
+The response is the gzipped schematic. Jobs are run by worker processes,
+forked once the IWADs are loaded. Each of them keeps the most recently used
+stacks of IWAD and PWADs, with their decoded graphics.
+"""
+
+
+import BaseHTTPServer
+import SocketServer
+import base64
+import collections
+import cStringIO
+import gzip
+import hashlib
+import json
+import multiprocessing
+import optparse
+import os
+import struct
+import sys
+import threading
+import traceback
+
+from wadcraft import colorcache
+from wadcraft import minecraft
+from wadcraft import render
+from wadcraft import waddecode
+from wadcraft import wadlib
+from wadcraft import wadutils
+
+
+class JobError(Exception):
+  """A job which cannot be run, because of its content."""
+
+
+def _pwad_key(pwad):
+  kind, value = pwad
+  if kind == 'data':
+    return kind, hashlib.sha1(value).hexdigest()
+  try:
+    return kind, os.path.abspath(value), os.stat(value).st_mtime
+  except OSError, e:
+    raise JobError('Unable to read pwad %s: %s' % (value, e.strerror))
+
+
+def _load_pwad(pwad):
+  kind, value = pwad
+  rawwad = waddecode.wad()
+  if kind == 'path':
+    rawwad.load(value, mapped=True)
+  else:
+    rawwad.loaddata(value, 'uploaded pwad')
+  return rawwad
+
+
+class WadStore(object):
+  """IWADs, and the most recently used stacks of an IWAD and PWADs."""
+
+  def __init__(self, iwads, max_stacks=8, pwad_dir=None):
+    self.iwads = collections.OrderedDict()
+    for fname in iwads:
+      print 'Loading iwad %s ...' % fname
+      rawwad = waddecode.wad()
+      rawwad.load(fname, mapped=True)
+      if rawwad.type != 'IWAD':
+        raise Exception('%s is not an iwad file.' % fname)
+      name = os.path.basename(fname).lower()
+      if name in self.iwads:
+        raise Exception('Several iwads are named %s.' % name)
+      self.iwads[name] = rawwad
+    self.max_stacks = max_stacks
+    self.pwad_dir = pwad_dir and os.path.realpath(pwad_dir)
+    self._stacks = collections.OrderedDict()
+
+  def get(self, iwad, pwads):
+    """Returns the wadlib.Wad of the iwad, with the pwads merged in order.
+
+    pwads are ('path', file name) or ('data', content) pairs.
+    """
+    rawiwad = self.iwads.get(iwad.lower())
+    if rawiwad is None:
+      raise JobError('Unknown iwad %s.' % iwad)
+    pwads = [(kind, self._resolve(value) if kind == 'path' else value)
+             for kind, value in pwads]
+    key = (iwad.lower(),) + tuple(_pwad_key(p) for p in pwads)
+    wad = self._stacks.pop(key, None)
+    if wad is None:
+      wad = self._stack(rawiwad, pwads)
+    self._stacks[key] = wad
+    while len(self._stacks) > self.max_stacks:
+      self._stacks.popitem(last=False)
+    return wad
+
+  def _resolve(self, fname):
+    """Returns the path of a pwad file, which must be in pwad_dir."""
+    if self.pwad_dir is None:
+      raise JobError('Pwad files are not served, use pwad_data.')
+    path = os.path.realpath(os.path.join(self.pwad_dir, fname))
+    if not path.startswith(os.path.join(self.pwad_dir, '')):
+      raise JobError('Pwad %s is not in the pwad directory.' % fname)
+    return path
+
+  def _stack(self, rawiwad, pwads):
+    if not pwads:
+      return wadlib.Wad(rawiwad)
+    # Merging changes the target, which must not be the loaded iwad.
+    rawwad = rawiwad.copy()
+    for pwad in pwads:
+      try:
+        newrawwad = _load_pwad(pwad)
+      except (IOError, struct.error, ValueError), e:
+        # Uploaded wads can be anything.
+        raise JobError('Unable to load pwad: %s' % e)
+      wadutils.mergewad(rawwad, newrawwad)
+    return wadlib.Wad(rawwad)
+
+
+def parse_job(content):
+  """Check a JSON job, and return it with defaults filled in."""
+  try:
+    job = json.loads(content)
+  except ValueError, e:
+    raise JobError('Invalid JSON: %s' % e)
+  if not isinstance(job, dict):
+    raise JobError('A job must be a JSON object.')
+
+  for name in ('iwad', 'level'):
+    if not isinstance(job.get(name), basestring):
+      raise JobError('Missing %s.' % name)
+  for name in ('pwads', 'pwad_data'):
+    if not isinstance(job.get(name, []), list):
+      raise JobError('%s must be a list.' % name)
+
+  pwads = [('path', str(p)) for p in job.get('pwads', [])]
+  try:
+    pwads += [('data', base64.b64decode(d))
+              for d in job.get('pwad_data', [])]
+  except TypeError:
+    raise JobError('Invalid base64 data in pwad_data.')
+
+  raster = job.get('raster', 'polygons')
+  if raster not in render.RASTER_ENGINES:
+    raise JobError('Unknown raster engine %s.' % raster)
+  torch_pattern = job.get('torch_pattern', 'hash')
+  if torch_pattern not in render.TORCH_PATTERNS:
+    raise JobError('Unknown torch pattern %s.' % torch_pattern)
+  try:
+    rotate = int(job.get('rotate', 0))
+    compress_level = int(job.get('compress_level', 9))
+  except (TypeError, ValueError):
+    raise JobError('rotate and compress_level must be integers.')
+  if not 1 <= compress_level <= 9:
+    raise JobError('compress_level must be between 1 and 9.')
+
+  return {
+      'iwad': str(job['iwad']),
+      'level': str(job['level']),
+      'pwads': pwads,
+      'raster': str(raster),
+      'torch_pattern': str(torch_pattern),
+      'rotate': rotate,
+      'compress_level': compress_level,
+  }
+
+
+# Wads and color cache of the worker processes. Like render._tile_renderer,
+# they are set before workers are forked.
+_store = None
+_color_cache = None
+
+
+def _convert(job):
+  """Worker side of Server.convert."""
+  wad = _store.get(job['iwad'], job['pwads'])
+  for levelname, rawlevel in wad.rawwad.levelindex.iteritems():
+    if levelname.lower() == job['level'].lower():
+      break
+  else:
+    raise JobError('Unable to find level %s' % job['level'])
+
+  print 'Converting level %s ...' % levelname
+  renderer = render.Render(wad, rawlevel, _color_cache, job['raster'], 1,
+                           job['torch_pattern'])
+  renderer.schematic.rotate(job['rotate'])
+
+  output = cStringIO.StringIO()
+  ofile = gzip.GzipFile(levelname, 'wb', job['compress_level'], output)
+  try:
+    renderer.schematic.write_nbt(minecraft.NBTWriter(ofile))
+  finally:
+    ofile.close()
+  return output.getvalue(), renderer.colors.new
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves /iwads and /convert."""
+
+  def do_GET(self):
+    if self.path != '/iwads':
+      self.send_error(404)
+      return
+    levels = dict((name, rawwad.levelindex.keys())
+                  for name, rawwad in self.server.store.iwads.iteritems())
+    self._reply(200, json.dumps(levels), 'application/json')
+
+  def do_POST(self):
+    if self.path != '/convert':
+      self.send_error(404)
+      return
+    try:
+      length = int(self.headers.getheader('content-length', ''))
+    except ValueError:
+      length = -1
+    if length < 0:
+      self._reply(400, 'Missing or invalid Content-Length.\n')
+      return
+    if length > self.server.max_upload:
+      self._reply(413, 'Jobs are limited to %d bytes.\n'
+                  % self.server.max_upload)
+      return
+    try:
+      job = parse_job(self.rfile.read(length))
+      data = self.server.convert(job)
+    except JobError, e:
+      self._reply(400, '%s\n' % e)
+      return
+    except Exception:
+      # Details can be internal, so they are only logged.
+      self.log_error('Conversion failed:\n%s', traceback.format_exc())
+      self._reply(500, 'Conversion failed.\n')
+      return
+    self._reply(200, data, 'application/octet-stream')
+
+  def _reply(self, code, body, content_type='text/plain'):
+    self.send_response(code)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """Conversion server, running jobs on a pool of worker processes."""
+
+  daemon_threads = True
+
+  def __init__(self, address, store, color_cache, workers=2,
+               max_upload=64<<20):
+    global _store, _color_cache
+    self.store = store
+    self.color_cache = color_cache
+    self.max_upload = max_upload
+    self._color_lock = threading.Lock()
+
+    # Fork the workers before any thread is started.
+    _store = store
+    _color_cache = color_cache
+    self.pool = multiprocessing.Pool(workers)
+
+    BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+
+  def convert(self, job):
+    """Run a job from parse_job() and returns the gzipped schematic."""
+    data, new_colors = self.pool.apply(_convert, (job,))
+    if new_colors:
+      # Workers only update their own copy of the color cache.
+      with self._color_lock:
+        for key, color in new_colors.iteritems():
+          self.color_cache.put(key, color)
+        self.color_cache.save()
+    return data
+
+  def server_close(self):
+    BaseHTTPServer.HTTPServer.server_close(self)
+    self.pool.terminate()
+    self.pool.join()
+
+
+def main():
+  """Run the conversion server."""
+
+  parser = optparse.OptionParser()
+
+  parser.add_option('-i', '--iwad', action='append', default=[],
+                    help='Iwad file to serve; can be repeated.')
+  parser.add_option('--host', default='localhost',
+                    help='Address to listen on [default: %default].')
+  parser.add_option('-p', '--port', type='int', default=8080,
+                    help='Port to listen on [default: %default].')
+  parser.add_option('-j', '--jobs', type='int', default=2,
+                    help='Number of worker processes [default: %default].')
+  parser.add_option('--pwad-dir',
+                    help='Directory of the pwad files jobs can use; jobs '
+                    'can only upload pwads without it.')
+  parser.add_option('--max-upload', type='int', default=64<<20,
+                    help='Maximal size of a job, in bytes, uploaded pwads '
+                    'included [default: %default].')
+  parser.add_option('--max-wads', type='int', default=8,
+                    help='Number of iwad and pwads stacks each worker keeps '
+                    'loaded [default: %default].')
+  parser.add_option('--color-cache', default=colorcache.default_path(),
+                    help='File caching the colors of flats and textures '
+                    'between runs [default: %default].')
+  parser.add_option('--no-color-cache', action='store_true', default=False,
+                    help='Do not read nor write the color cache.')
+
+  (opts, args) = parser.parse_args()
+
+  if not opts.iwad:
+    print 'Please specifiy which iwads to serve.'
+    print
+    parser.print_help()
+    sys.exit(1)
+
+  store = WadStore(opts.iwad, opts.max_wads, opts.pwad_dir)
+  color_cache = colorcache.ColorCache(
+      None if opts.no_color_cache else opts.color_cache)
+  color_cache.load()
+
+  server = Server((opts.host, opts.port), store, color_cache, opts.jobs,
+                  opts.max_upload)
+  print 'Serving on http://%s:%d/ ...' % (opts.host, opts.port)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    color_cache.save()
@@ -0,0 +1,104 @@
+# Wadcraft is a program converting Doom WAD levels to minecraft format.
+# (C) 2011 Pierre Palatin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+import base64
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from wadcraft import server
+
+
+class ParseJobTest(unittest.TestCase):
+
+  def parse(self, **job):
+    return server.parse_job(json.dumps(job))
+
+  def test_defaults(self):
+    job = self.parse(iwad='doom.wad', level='E1M1')
+    self.assertEqual(job, {
+        'iwad': 'doom.wad',
+        'level': 'E1M1',
+        'pwads': [],
+        'raster': 'polygons',
+        'torch_pattern': 'hash',
+        'rotate': 0,
+        'compress_level': 9,
+    })
+
+  def test_pwads(self):
+    job = self.parse(iwad='doom.wad', level='E1M1', pwads=['a.wad'],
+                     pwad_data=[base64.b64encode('PWAD')])
+    self.assertEqual(job['pwads'], [('path', 'a.wad'), ('data', 'PWAD')])
+
+  def test_invalid(self):
+    for content in (
+        'not json',
+        '[]',
+        json.dumps({'level': 'E1M1'}),
+        json.dumps({'iwad': 'doom.wad', 'level': 1}),
+        json.dumps({'iwad': 'doom.wad', 'level': 'E1M1', 'pwads': 'a.wad'}),
+        json.dumps({'iwad': 'doom.wad', 'level': 'E1M1',
+                    'pwad_data': ['A']}),
+        json.dumps({'iwad': 'doom.wad', 'level': 'E1M1', 'raster': 'x'}),
+        json.dumps({'iwad': 'doom.wad', 'level': 'E1M1',
+                    'torch_pattern': 'x'}),
+        json.dumps({'iwad': 'doom.wad', 'level': 'E1M1', 'rotate': 'x'}),
+        json.dumps({'iwad': 'doom.wad', 'level': 'E1M1',
+                    'compress_level': 10})):
+      self.assertRaises(server.JobError, server.parse_job, content)
+
+
+class ResolveTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.pwad_dir = os.path.join(self.tmpdir, 'pwads')
+    os.mkdir(self.pwad_dir)
+    open(os.path.join(self.pwad_dir, 'map.wad'), 'w').close()
+    open(os.path.join(self.tmpdir, 'secret.wad'), 'w').close()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_inside(self):
+    store = server.WadStore([], pwad_dir=self.pwad_dir)
+    self.assertEqual(store._resolve('map.wad'),
+                     os.path.join(os.path.realpath(self.pwad_dir), 'map.wad'))
+
+  def test_outside(self):
+    store = server.WadStore([], pwad_dir=self.pwad_dir)
+    for fname in ('../secret.wad', os.path.join(self.tmpdir, 'secret.wad'),
+                  '../pwads2/map.wad'):
+      self.assertRaises(server.JobError, store._resolve, fname)
+
+  def test_symlink(self):
+    os.symlink(os.path.join(self.tmpdir, 'secret.wad'),
+               os.path.join(self.pwad_dir, 'link.wad'))
+    store = server.WadStore([], pwad_dir=self.pwad_dir)
+    self.assertRaises(server.JobError, store._resolve, 'link.wad')
+
+  def test_no_pwad_dir(self):
+    store = server.WadStore([])
+    self.assertRaises(server.JobError, store._resolve, 'map.wad')
+
+
+if __name__ == '__main__':
+  unittest.main()
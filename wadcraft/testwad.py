@@ -0,0 +1,186 @@
+# Wadcraft is a program converting Doom WAD levels to minecraft format.
+# (C) 2011 Pierre Palatin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+"""Small synthetic IWAD, for the tests.
+
+MAP01 is three rooms in a row, from west to east:
+  0: a lit room, where the player starts.
+  1: a closed door, floor and ceiling at 0.
+  2: a raised outdoor room, with a sky ceiling.
+Rooms are separated by two-sided linedefs. GL nodes are built in the wad,
+so it needs no GWA file.
+"""
+
+
+import random
+import struct
+
+from wadcraft import waddecode
+from wadcraft import wadlib
+
+
+VERTICES = [(0, 0), (0, 256), (256, 256), (256, 0), (288, 256), (288, 0),
+            (544, 256), (544, 0)]
+# v1, v2, flags, special, tag, right sidedef, left sidedef.
+LINEDEFS = [(0, 1, 1, 0, 0, 0, -1), (1, 2, 1, 0, 0, 1, -1),
+            (3, 0, 1, 0, 0, 2, -1), (2, 3, 4, 0, 0, 3, 4),
+            (2, 4, 1, 0, 0, 5, -1), (5, 3, 1, 0, 0, 6, -1),
+            (4, 5, 4, 0, 0, 7, 8), (4, 6, 1, 0, 0, 9, -1),
+            (6, 7, 1, 0, 0, 10, -1), (7, 5, 1, 0, 0, 11, -1)]
+# x offset, y offset, upper, lower, middle, sector.
+SIDEDEFS = [(0, 0, '-', '-', 'WALL', 0), (0, 0, '-', '-', 'WALL2', 0),
+            (0, 0, '-', '-', 'WALL', 0), (0, 0, 'WALL2', '-', '-', 0),
+            (0, 0, '-', '-', '-', 1), (0, 0, '-', '-', 'WALL', 1),
+            (0, 0, '-', '-', 'WALL', 1), (0, 0, '-', '-', '-', 1),
+            (0, 0, 'WALL', 'WALL2', '-', 2), (0, 0, '-', '-', 'WALL2', 2),
+            (0, 0, '-', '-', 'WALL', 2), (0, 0, '-', '-', 'WALL', 2)]
+# floor, ceiling, floor flat, ceiling flat, light, special, tag.
+SECTORS = [(0, 128, 'FLOOR', 'CEIL', 160, 0, 0),
+           (0, 0, 'FLOOR', 'CEIL', 128, 0, 0),
+           (16, 160, 'FLOOR2', 'F_SKY1', 255, 0, 0)]
+# x, y, angle, type, flags.
+THINGS = [(128, 128, 0, 1, 7), (400, 100, 0, 2001, 7)]
+
+# v1, v2, linedef, side, partner; one subsector of 4 segments per room.
+_NONE = 0xffffffff
+GL_SEGS = [(0, 1, 0, 0, _NONE), (1, 2, 1, 0, _NONE), (2, 3, 3, 0, 4),
+           (3, 0, 2, 0, _NONE), (3, 2, 3, 1, 2), (2, 4, 4, 0, _NONE),
+           (4, 5, 6, 0, 8), (5, 3, 5, 0, _NONE), (5, 4, 6, 1, 6),
+           (4, 6, 7, 0, _NONE), (6, 7, 8, 0, _NONE), (7, 5, 9, 0, _NONE)]
+# x, y, dx, dy, right box, left box, right child, left child.
+_SUBSECTOR = 1 << 31
+GL_NODES = [(256, 0, 0, 256, 256, 0, 256, 288, 256, 0, 0, 256,
+             1 | _SUBSECTOR, 0 | _SUBSECTOR),
+            (288, 0, 0, 256, 256, 0, 288, 544, 256, 0, 0, 288,
+             2 | _SUBSECTOR, 0)]
+
+
+def _blockmap(size=128):
+  """BLOCKMAP lump, with each linedef in the blocks its bounding box
+  overlaps."""
+  x0 = min(x for x, _ in VERTICES) - 8
+  y0 = min(y for _, y in VERTICES) - 8
+  cols = (max(x for x, _ in VERTICES) - x0) // size + 1
+  rows = (max(y for _, y in VERTICES) - y0) // size + 1
+  offsets = []
+  words = []
+  for row in range(rows):
+    for col in range(cols):
+      x1, y1 = x0 + col * size, y0 + row * size
+      offsets.append(4 + cols * rows + len(words))
+      words.append(0)
+      for i, linedef in enumerate(LINEDEFS):
+        (ax, ay), (bx, by) = VERTICES[linedef[0]], VERTICES[linedef[1]]
+        if (min(ax, bx) < x1 + size and max(ax, bx) >= x1 and
+            min(ay, by) < y1 + size and max(ay, by) >= y1):
+          words.append(i)
+      words.append(0xffff)
+  return (struct.pack('<hhHH', x0, y0, cols, rows) +
+          ''.join(struct.pack('<H', w) for w in offsets + words))
+
+
+def _patch(width, height, rnd):
+  """Patch of a single post per column."""
+  columns = [chr(0) + chr(height) + '\0' +
+             ''.join(chr(rnd.randrange(256)) for _ in range(height)) +
+             '\0\xff' for _ in range(width)]
+  offsets = []
+  offset = 8 + 4 * width
+  for column in columns:
+    offsets.append(offset)
+    offset += len(column)
+  return (struct.pack('<HHhh', width, height, 0, 0) +
+          ''.join(struct.pack('<l', o) for o in offsets) + ''.join(columns))
+
+
+def _texture_lump(textures):
+  defs = [struct.pack('<8sHHHHHHH', name, 0, 0, width, height, 0, 0,
+                      len(patches)) +
+          ''.join(struct.pack('<hhhhh', *p) for p in patches)
+          for name, width, height, patches in textures]
+  offsets = []
+  offset = 4 + 4 * len(defs)
+  for texdef in defs:
+    offsets.append(offset)
+    offset += len(texdef)
+  return (struct.pack('<L', len(defs)) +
+          ''.join(struct.pack('<L', o) for o in offsets) + ''.join(defs))
+
+
+def lumps():
+  """Returns the (name, data) lumps of the wad."""
+  rnd = random.Random(1)
+  playpal = ''.join(chr(rnd.randrange(256)) for _ in range(768))
+
+  def pack(fmt, rows):
+    return ''.join(struct.pack(fmt, *row) for row in rows)
+
+  result = [
+      ('PLAYPAL', playpal * 14),
+      ('MAP01', ''),
+      ('THINGS', pack('<hhhhh', THINGS)),
+      ('LINEDEFS', pack('<4H3h', LINEDEFS)),
+      ('SIDEDEFS', pack('<hh8s8s8sh', SIDEDEFS)),
+      ('VERTEXES', pack('<hh', VERTICES)),
+      ('SEGS', ''),
+      ('SSECTORS', ''),
+      ('NODES', ''),
+      ('SECTORS', pack('<hh8s8shhh', SECTORS)),
+      ('REJECT', ''),
+      ('BLOCKMAP', _blockmap()),
+      ('GL_MAP01', ''),
+      ('GL_VERT', 'gNd5'),
+      ('GL_SEGS', pack('<IIHHI', GL_SEGS)),
+      ('GL_SSECT', pack('<II', [(4, 4 * i) for i in range(3)])),
+      ('GL_NODES', pack('<12hII', GL_NODES)),
+      ('GL_PVS', ''),
+      ('P_START', ''),
+      ('WALLP', _patch(64, 128, rnd)),
+      ('WALLQ', _patch(32, 64, rnd)),
+      ('P_END', ''),
+      ('PNAMES', struct.pack('<l', 2) + pack('<8s', [('WALLP',), ('WALLQ',)])),
+      ('TEXTURE1', _texture_lump([
+          ('WALL', 64, 128, [(0, 0, 0, 1, 0)]),
+          ('WALL2', 64, 64, [(-8, -4, 1, 1, 0), (40, 10, 1, 1, 0)])])),
+      ('F_START', '')]
+  for i, name in enumerate(('FLOOR', 'CEIL', 'FLOOR2', 'F_SKY1')):
+    # Each flat in its own part of the palette, so they get distinct colors.
+    result.append((name, ''.join(chr(rnd.randrange(i * 60, i * 60 + 40))
+                                 for _ in range(4096))))
+  result.append(('F_END', ''))
+  return result
+
+
+def data(kind='IWAD'):
+  """Returns the content of the wad file."""
+  content = ''
+  index = []
+  offset = 12
+  for name, lump in lumps():
+    index.append((offset, len(lump), name))
+    content += lump
+    offset += len(lump)
+  return (struct.pack('<4sii', kind, len(index), offset) + content +
+          ''.join(struct.pack('<ii8s', *entry) for entry in index))
+
+
+def load():
+  """Returns the wad, as a wadlib.Wad."""
+  rawwad = waddecode.wad()
+  rawwad.loaddata(data(), 'test wad')
+  return wadlib.Wad(rawwad)
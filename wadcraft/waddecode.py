@@ -19,10 +19,14 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import collections
 import struct
 from math import sqrt
+import mmap
 import os
 
+import numpy
+
 headerstruct = '<4sii'
 indexstruct = '<ii8s'
 
@@ -45,19 +49,145 @@ texturestruct = '<8sHHHHHHH'
 patchdescstruct = '<hhhhh'
 
 # We only support level 5 GL nodes.
-glvertstruct = '<hhhh'
+glvertstruct = '<HhHh'
 glsegstruct = '<IIHHI'
 glssectorstruct = '<II'
-glnodestruct = nodestruct # The only identical element.
+glnodestruct = '<12hII' # Like nodes, but with 32 bits children.
 glmagicid = 'gNd5'
 
+# The same record layouts as numpy dtypes, to decode whole lumps in one
+# go. Fields are in struct order.
+doomthingdtype = numpy.dtype([
+    ('x', '<i2'), ('y', '<i2'), ('angle', '<i2'), ('type', '<i2'),
+    ('flags', '<i2')])
+hexenthingdtype = numpy.dtype([
+    ('tid', '<i2'), ('x', '<i2'), ('y', '<i2'), ('z', '<i2'),
+    ('angle', '<i2'), ('type', '<i2'), ('flags', '<u2'),
+    ('special', 'i1'), ('arg0', 'u1'), ('arg1', 'u1'), ('arg2', 'u1'),
+    ('arg3', 'u1'), ('arg4', 'u1')])
+doomlinedefdtype = numpy.dtype([
+    ('v1', '<u2'), ('v2', '<u2'), ('flags', '<u2'), ('special', '<u2'),
+    ('tag', '<i2'), ('right', '<i2'), ('left', '<i2')])
+hexenlinedefdtype = numpy.dtype([
+    ('v1', '<u2'), ('v2', '<u2'), ('flags', '<u2'), ('special', 'u1'),
+    ('arg0', 'u1'), ('arg1', 'u1'), ('arg2', 'u1'), ('arg3', 'u1'),
+    ('arg4', 'u1'), ('right', '<i2'), ('left', '<i2')])
+sidedefdtype = numpy.dtype([
+    ('xoffset', '<i2'), ('yoffset', '<i2'), ('upper', 'S8'),
+    ('lower', 'S8'), ('middle', 'S8'), ('sector', '<i2')])
+vertexdtype = numpy.dtype([('x', '<i2'), ('y', '<i2')])
+segdtype = numpy.dtype([
+    ('v1', '<i2'), ('v2', '<i2'), ('angle', '<i2'), ('linedef', '<i2'),
+    ('side', '<i2'), ('offset', '<i2')])
+ssectordtype = numpy.dtype([('count', '<u2'), ('first', '<u2')])
+sectordtype = numpy.dtype([
+    ('floor', '<i2'), ('ceiling', '<i2'), ('floorflat', 'S8'),
+    ('ceilflat', 'S8'), ('light', '<i2'), ('special', '<i2'),
+    ('tag', '<i2')])
+
+# GL vertices are 16.16 fixed point; x and y are the integer parts, and the
+# fractions are unsigned.
+glvertdtype = numpy.dtype([
+    ('xfrac', '<u2'), ('x', '<i2'), ('yfrac', '<u2'), ('y', '<i2')])
+glsegdtype = numpy.dtype([
+    ('v1', '<u4'), ('v2', '<u4'), ('linedef', '<u2'), ('side', '<u2'),
+    ('partner', '<u4')])
+glssectordtype = numpy.dtype([('count', '<u4'), ('first', '<u4')])
+# Bit 31 of a child tells it is a subsector rather than a node.
+glnodedtype = numpy.dtype([
+    ('x', '<i2'), ('y', '<i2'), ('dx', '<i2'), ('dy', '<i2'),
+    ('rbox', '<i2', (4,)), ('lbox', '<i2', (4,)),
+    ('right', '<u4'), ('left', '<u4')])
+
+# Lumps which may follow a level marker, and the level attribute they
+# are stored in. GL nodes also have a GL_<level name> marker.
+levellumps = {
+    'THINGS': 'things',
+    'LINEDEFS': 'linedefs',
+    'SIDEDEFS': 'sidedefs',
+    'VERTEXES': 'vertexes',
+    'SEGS': 'segs',
+    'SSECTORS': 'ssectors',
+    'NODES': 'nodes',
+    'SECTORS': 'sectors',
+    'REJECT': 'reject',
+    'BLOCKMAP': 'blockmap',
+    'BEHAVIOR': 'behavior',
+    'GL_VERT': 'glvert',
+    'GL_SEGS': 'glsegs',
+    'GL_SSECT': 'glssect',
+    'GL_NODES': 'glnodes',
+    'GL_PVS': 'glpvs',
+}
+
 from waddata import extragraphics
 
+class mappedfile:
+    """Read-only file object backed by a memory map. read() returns
+    buffer views on the mapping instead of copies, so lumps loaded
+    through it cost nothing until their data is actually used."""
+    def __init__(self, fname):
+        ifile = file(fname, 'rb')
+        try:
+            self.mapping = mmap.mmap(ifile.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+        except ValueError, e:
+            # Empty files cannot be mapped.
+            raise IOError('Unable to map %s: %s' % (fname, e))
+        finally:
+            ifile.close()
+        self.pos = 0
+
+    def seek(self, pos):
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size):
+        data = buffer(self.mapping, self.pos, size)
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        # The mapping stays alive as long as some lump references it.
+        pass
+
+class bufferfile(mappedfile):
+    """Like mappedfile, but on a string already in memory."""
+    def __init__(self, data):
+        self.mapping = data
+        self.pos = 0
+
 class lump:
+    # Attributes computed by unpack(). For lumps created with
+    # fromlump(..., lazy=True) they are only computed on first access.
+    unpacked = ()
+
     def __init__(self):
         self.data = ''
         self.name = ''
 
+    def __getattr__(self, attr):
+        if attr in self.unpacked and self.__dict__.get('pending', False):
+            # Stay pending if it fails, so that it fails again next time.
+            self.unpack()
+            del self.pending
+            return getattr(self, attr)
+        raise AttributeError(attr)
+
+    def defer(self):
+        """Postpone unpacking until an unpacked attribute is needed. The
+        data is still checked now, so that a bad lump fails to load."""
+        self.check()
+        for attr in self.unpacked:
+            self.__dict__.pop(attr, None)
+        self.pending = True
+
+    def check(self):
+        """Raise the errors unpack() would raise, without unpacking."""
+        pass
+
     def load(self, ifile, size, name):
         """Read lump from the file at the specified location."""
         self.data = ifile.read(size)
@@ -101,16 +231,119 @@ class wad:
         self.texture1 = None
         self.texture2 = None
         self.pnames = None
+        self.mapped = False
+        # Name -> lump indexes of the lists above. When several lumps
+        # have the same name, the last one wins.
+        self.flatindex = collections.OrderedDict()
+        self.patchindex = collections.OrderedDict()
+        self.spriteindex = collections.OrderedDict()
+        self.levelindex = collections.OrderedDict()
+        # Name -> position in the lists above of the first lump with
+        # that name, so that merging does not have to look for them.
+        self.flatpositions = {}
+        self.patchpositions = {}
+        self.spritepositions = {}
+        self.levelpositions = {}
+        self.patchcache = {}
+        self.texturecache = collections.OrderedDict()
+        self.texturecachesize = 256
+        self.histogramcache = {}
+
+    def decodepatch(self, p):
+        """Returns patch.decode() of the given patch, cached by name."""
+        cached = self.patchcache.get(p.name)
+        if cached is None or cached[0] is not p:
+            cached = (p, p.decode())
+            self.patchcache[p.name] = cached
+        return cached[1]
+
+    def composetexture(self, texdef, patchdict):
+        """Returns composetexture() of the given texture definition, using
+        the patch cache. Composites of the texturecachesize most recently
+        used textures are kept, by name."""
+        name = texdef[0]
+        cached = self.texturecache.pop(name, None)
+        if cached is None or cached[0] is not texdef:
+            cached = (texdef, composetexture(texdef, patchdict, self))
+        self.texturecache[name] = cached
+        while len(self.texturecache) > self.texturecachesize:
+            self.texturecache.popitem(last=False)
+        return cached[1]
+
+    def flathistogram(self, f):
+        """Returns histogram() of the given flat, cached by name."""
+        key = ('flat', f.name)
+        cached = self.histogramcache.get(key)
+        if cached is None or cached[0] is not f:
+            raw = numpy.frombuffer(f.data, numpy.uint8)
+            cached = (f, histogram(raw[:f.width*f.height]))
+            self.histogramcache[key] = cached
+        return cached[1]
+
+    def texturehistogram(self, texdef, patchdict):
+        """Returns histogram() of the given texture definition, cached by
+        name."""
+        key = ('texture', texdef[0])
+        cached = self.histogramcache.get(key)
+        if cached is None or cached[0] is not texdef:
+            cached = (texdef,
+                      histogram(*self.composetexture(texdef, patchdict)))
+            self.histogramcache[key] = cached
+        return cached[1]
+
+    def buildindexes(self):
+        """Rebuilds the name indexes and positions from the lump lists."""
+        for array, index, positions in (
+                (self.flats, self.flatindex, self.flatpositions),
+                (self.patches, self.patchindex, self.patchpositions),
+                (self.sprites, self.spriteindex, self.spritepositions)):
+            index.clear()
+            positions.clear()
+            for i, l in enumerate(array):
+                index[l.name] = l
+                positions.setdefault(l.name, i)
+        self.levelindex.clear()
+        for l in self.levels:
+            self.levelindex[l.header.name] = l
+        self.buildlevelpositions()
+
+    def buildlevelpositions(self):
+        """Rebuilds levelpositions, after the levels are reordered."""
+        self.levelpositions.clear()
+        for i, l in enumerate(self.levels):
+            self.levelpositions.setdefault(l.header.name, i)
+
+    def copy(self):
+        """Returns a wad with the same lumps, that other wads can be
+        merged into without changing this one. It starts with the
+        patches this one already decoded, in a cache of its own, so the
+        patches of merged wads do not evict them; composed textures are
+        not kept, since they depend on the patches of the wad."""
+        other = wad()
+        other.type = self.type
+        other.fname = self.fname
+        other.mapped = self.mapped
+        for attr in ('lumps', 'music', 'sfx', 'patches', 'sprites',
+                     'flats', 'levels', 'extragraphics'):
+            setattr(other, attr, list(getattr(self, attr)))
+        for attr in ('playpal', 'texture1', 'texture2', 'pnames'):
+            setattr(other, attr, getattr(self, attr))
+        for attr in ('flatindex', 'patchindex', 'spriteindex',
+                     'levelindex', 'flatpositions', 'patchpositions',
+                     'spritepositions', 'levelpositions'):
+            setattr(other, attr, getattr(self, attr).copy())
+        other.patchcache = dict(self.patchcache)
+        return other
 
     def printlumplist(self, llist):
         for l in llist:
             print l.name
 
-    def load(self, fname):
-        """Load a WAD file from disk."""
+    def readindex(self, ifile, fname):
+        """Reads the header and the lump directory of an opened WAD
+        file. Returns the index as a list of (offset, size, name)."""
         # Start with the header.
         global headerstruct
-        ifile = file(fname, 'rb')
         he = ifile.read(struct.calcsize(headerstruct))
         (wtype, numlumps, ioffset) = struct.unpack(headerstruct, he)
         if wtype != 'IWAD' and wtype != 'PWAD':
@@ -121,12 +354,57 @@ class wad:
         # Then read the index.
         ifile.seek(ioffset)
         index = []
+        isize = struct.calcsize(indexstruct)
+        idata = ifile.read(numlumps*isize)
         for i in range(numlumps):
-            idata = ifile.read(struct.calcsize(indexstruct))
-            (loffset, lsize, lname) = struct.unpack(indexstruct, idata)
+            (loffset, lsize, lname) = struct.unpack(indexstruct, \
+                                        idata[i*isize:(i+1)*isize])
             lname = lname.split('\0')[0] # Makes string comparison work.
             ltuple = (loffset, lsize, lname)
             index.append(ltuple)
+        return index
+
+    def scanlevels(self, fname):
+        """Returns the names of the levels in a WAD file. Only the
+        directory is read."""
+        ifile = file(fname, 'rb')
+        try:
+            index = self.readindex(ifile, fname)
+        finally:
+            ifile.close()
+        names = []
+        for i in range(len(index)-1):
+            if index[i+1][2] == 'THINGS':
+                names.append(index[i][2])
+        return names
+
+    def load(self, fname, mapped=False, levels=None):
+        """Load a WAD file from disk.
+
+        If mapped is true, the file is memory-mapped instead: lumps are
+        views on the mapping and graphics are unpacked on first use.
+        If levels is a list of level names, other levels are skipped
+        without reading their lumps."""
+        if mapped:
+            ifile = mappedfile(fname)
+        else:
+            ifile = file(fname, 'rb')
+        self.loadfile(ifile, fname, mapped, levels)
+
+        # Load external GL nodes.
+        self.importgwa(fname)
+
+    def loaddata(self, data, name, levels=None):
+        """Load a WAD from a string, as if it was a mapped file. name is
+        only used in messages; there is no GWA file for such WADs."""
+        self.loadfile(bufferfile(data), name, True, levels)
+
+    def loadfile(self, ifile, fname, mapped, levels):
+        """Load a WAD from an opened file, which is closed afterwards."""
+        index = self.readindex(ifile, fname)
+        self.mapped = mapped
+        if levels is not None:
+            levels = set([l.upper() for l in levels])
 
         #printindex(index)
 
@@ -135,17 +413,21 @@ class wad:
         while i < len(index):
             ltuple = index[i]
             (loffset, lsize, lname) = ltuple
-            ifile.seek(loffset)
-            newlump = lump()
-            newlump.load(ifile, lsize, lname)
 
             # If next index item is THINGS, we have a new level.
             if i < len(index)-1 and index[i+1][2] == 'THINGS':
+                if levels is not None and lname.upper() not in levels:
+                    i = levelend(index, i)
+                    continue
                 newlevel = level()
                 i = newlevel.load(ifile, index, i)
                 self.levels.append(newlevel)
                 continue
 
+            ifile.seek(loffset)
+            newlump = lump()
+            newlump.load(ifile, lsize, lname)
+
             # Place the lump in an appropriate place.
             if lname[0:2] == 'D_': # Music
                 self.music.append(newlump)
@@ -197,50 +479,52 @@ class wad:
         # them to their native types
         for i in range(len(self.flats)):
             newflat = flat()
-            newflat.fromlump(self.flats[i])
+            newflat.fromlump(self.flats[i], mapped)
             self.flats[i] = newflat
 
         for i in range(len(self.patches)):
             newpatch = patch()
-            newpatch.fromlump(self.patches[i])
+            newpatch.fromlump(self.patches[i], mapped)
             self.patches[i] = newpatch
 
         for i in range(len(self.sprites)):
             newsprite = patch()
-            newsprite.fromlump(self.sprites[i])
+            newsprite.fromlump(self.sprites[i], mapped)
             self.sprites[i] = newsprite
 
         for i in range(len(self.extragraphics)):
             newgraph = patch()
-            newgraph.fromlump(self.extragraphics[i])
+            newgraph.fromlump(self.extragraphics[i], mapped)
             self.extragraphics[i] = newgraph
 
         # Sort the levels according to their name.
         self.levels.sort(levelsorter)
-        
-        # Load external GL nodes.
-        self.importgwa(fname)
+        self.buildindexes()
 
     def importgwa(self, fname):
         """Loads GL nodes from an external GWA file, if it is newer
         than the current wad."""
 
-        # Avoid recursive calls.
+        # GWA files have no companion GWA.
         if fname[-3:].lower() == 'gwa':
             return
 
         gwaname_lower = fname[:-3] + 'gwa'
         gwaname_upper = fname[:-3] + 'GWA'
 
+        # Only the directory is read here; GL lumps of a level are read
+        # from the mapping when the level first needs them.
         gwafile = wad()
         try:
-            gwafile.load(gwaname_lower)
             gwaname = gwaname_lower
-        except IOError:
+            ifile = mappedfile(gwaname)
+            index = gwafile.readindex(ifile, gwaname)
+        except (IOError, struct.error):
             try:
-                gwafile.load(gwaname_upper)
                 gwaname = gwaname_upper
-            except IOError:
+                ifile = mappedfile(gwaname)
+                index = gwafile.readindex(ifile, gwaname)
+            except (IOError, struct.error):
                 print 'No corresponding GWA file.'
                 return
 
@@ -254,31 +538,14 @@ class wad:
 
         # At this point we have a GWA file that has newer GL Node data
         # than the wad itself. Import it.
+        markers = {}
+        for i, (loffset, lsize, lname) in enumerate(index):
+            if lname.startswith('GL_') and lname not in levellumps:
+                markers[lname] = i
         for level in self.levels:
-            glmark = 'GL_' + level.header.name
-
-            # GWA files contain only plain lumps.
-            i = 0
-            while i < len(gwafile.lumps):
-                lump = gwafile.lumps[i]
-                if lump.name == glmark:
-                    level.glheader = lump
-                    i = i+1
-                    level.glvert = gwafile.lumps[i]
-                    i = i+1
-                    level.glsegs = gwafile.lumps[i]
-                    i = i+1
-                    level.glssect = gwafile.lumps[i]
-                    i = i+1
-                    level.glnodes = gwafile.lumps[i]
-                    i = i+1
-                    level.glpvs = gwafile.lumps[i]
-                    if gwafile.lumps[i].name != 'GL_PVS':
-                        raise Exception('Malformed GL nodes in GWA file.')
-                    break # This level is done
-                i = i + 1
-                
-
+            i = markers.get('GL_' + level.header.name)
+            if i is not None:
+                level.attachgl(ifile, index, i)
 
     def loadseries(self, ifile, index, i, stop1, stop2, array):
         """Read a sequence of lumps (patches, flats etc)."""
@@ -301,6 +568,11 @@ class wad:
     def save(self, ofname=None):
         """Writes the data to the given file."""
 
+        # Lumps are views on the source file, which we could be about
+        # to truncate.
+        if self.mapped:
+            raise IOError('Can not save a memory-mapped wad.')
+
         if ofname is not None:
             self.fname = ofname
 
@@ -372,6 +644,9 @@ class wad:
 
 class patch(lump):
     """A basic Doom graphic element."""
+    unpacked = ('width', 'height', 'loffset', 'toffset', 'offsets',
+                'columnformat')
+
     def __init__(self):
         lump.__init__(self)
         self.width = 0
@@ -385,10 +660,13 @@ class patch(lump):
         lump.load(self, ifile, size, name)
         self.unpack()
 
-    def fromlump(self, lump):
+    def fromlump(self, lump, lazy=False):
         self.name = lump.name
         self.data = lump.data
-        self.unpack()
+        if lazy:
+            self.defer()
+        else:
+            self.unpack()
 
     def unpack(self):
         if len(self.data) == 320*200:
@@ -402,6 +680,15 @@ class patch(lump):
         else:
             self.unpackcolumn()
             self.columnformat = True
+
+    def check(self):
+        if len(self.data) == 320*200:
+            return
+        hsize = struct.calcsize(patchheaderstruct)
+        width = struct.unpack(patchheaderstruct, self.data[:hsize])[0]
+        osize = struct.calcsize(patchoffsetstruct)
+        if len(self.data) < hsize + width*osize:
+            raise struct.error('Patch %s is truncated.' % self.name)
             
 
     def unpackcolumn(self):
@@ -432,29 +719,40 @@ class patch(lump):
 
     def getcolumngraphic(self, transparentcolor):
         """Returns an array of arrays containing the indexed image."""
-        result = []
-        for i in range(self.height):
-            row = [transparentcolor]*self.width
-            result.append(row)
-
-        # Iterate over every column
+        return self.decode(transparentcolor)[0].tolist()
+
+    def decode(self, transparentcolor=247):
+        """Returns (image, mask) numpy uint8 and bool arrays, indexed
+        [y][x]. The mask tells which pixels are opaque; transparent
+        pixels are set to transparentcolor in the image."""
+        raw = numpy.frombuffer(self.data, numpy.uint8)
+        if not self.columnformat:
+            image = raw[:self.width*self.height]
+            image = image.reshape(self.height, self.width)
+            return image, numpy.ones(image.shape, bool)
+
+        image = numpy.empty((self.height, self.width), numpy.uint8)
+        image.fill(transparentcolor)
+        mask = numpy.zeros((self.height, self.width), bool)
+
+        # Each column is a list of posts: a start row, a pixel count, a
+        # garbage byte, the pixels and another garbage byte.
+        data = self.data
         for i in range(self.width):
-            base = self.offsets[i]
-            inc = 0
-            while (struct.unpack('<B', self.data[base+inc])[0]) != 0xFF:
-                j = struct.unpack('<B', self.data[base+inc])[0]
-                inc = inc + 1
-                count = struct.unpack('<B', self.data[base+inc])[0]
-                inc = inc + 2 # Skip the garbage pixel.
-                for c in range(count):
-                    result[j][i] = struct.unpack('<B', self.data[base+inc])[0]
-                    j = j+1
-                    inc = inc+1
-                inc = inc+1 # Skip other garbage pixel.
-        return result
+            inc = self.offsets[i]
+            j = ord(data[inc])
+            while j != 0xFF:
+                count = ord(data[inc+1])
+                image[j:j+count, i] = raw[inc+3:inc+3+count]
+                mask[j:j+count, i] = True
+                inc = inc + count + 4
+                j = ord(data[inc])
+        return image, mask
                     
 class flat(lump):
     """A square floor graphic."""
+    unpacked = ('width', 'height')
+
     def __init__(self):
         lump.__init__(self)
         self.width = 0
@@ -464,30 +762,35 @@ class flat(lump):
         lump.load(self, ifile, size, name)
         self.unpack()
 
-    def fromlump(self, lump):
+    def fromlump(self, lump, lazy=False):
         """Take data from another lump and unpack it."""
         self.name = lump.name
         self.data = lump.data
-        self.unpack()
+        if lazy:
+            self.defer()
+        else:
+            self.unpack()
 
     def unpack(self):
         """Sanity checks and unpacking."""
+        self.width, self.height = self.dimensions()
+
+    def check(self):
+        self.dimensions()
+
+    def dimensions(self):
+        """Returns (width, height), from the size of the data."""
         # Heretic has a few 64*65 flats.
         if len(self.data) == 64*65:
-            self.width = 64
-            self.height = 65
-            return
+            return 64, 65
         # Hexen has flats sized 8192.
         if len(self.data) == 8192:
-            self.width = 128
-            self.height = 64
-            return
+            return 128, 64
         w = sqrt(len(self.data))
         w = int(w)
         if w*w != len(self.data):
             raise Exception('Flat %s is not square (%d bytes).' % (self.name, len(self.data)))
-        self.width = w
-        self.height = w
+        return w, w
 
     def getgraphic(self):
         """Returns an array of arrays containing the indexed image."""
@@ -518,26 +821,18 @@ class playpal(lump):
         self.unpack()
 
     def unpack(self):
-        """Transforms the binary data to editable form."""
+        """Transforms the binary data to a (palettes, 256, 4) uint8 numpy
+        array of RGBA colors."""
         palsize = 256*3
         numpals = len(self.data) / palsize
         alphaind = 247 # This value is the same in every game
         if len(self.data) != numpals*palsize: # 
             raise Exception('Incorrect palette size %d.' % len(self.data))
-        self.palettes = []
-        for p in range(numpals):
-            base = p*palsize
-            cpal = []
-            self.palettes.append(cpal)
-            for i in range(256):
-                ind = base + i*3
-                (r, g, b) = struct.unpack('<BBB', self.data[ind:ind+3])
-                if i == alphaind:
-                    a = 0
-                else:
-                    a = 255
-                tp = (r, g, b, a)
-                cpal.append(tp)
+        rgb = numpy.frombuffer(self.data, numpy.uint8, numpals*palsize)
+        self.palettes = numpy.empty((numpals, 256, 4), numpy.uint8)
+        self.palettes[:, :, :3] = rgb.reshape(numpals, 256, 3)
+        self.palettes[:, :, 3] = 255
+        self.palettes[:, alphaind, 3] = 0
 
 class pnames(lump):
     def __init__(self):
@@ -614,12 +909,37 @@ class level:
 
         # GL nodes, if the first one is None, these will not be
         # written to disk.
-        self.glheader = None
-        self.glvert = None
-        self.glsegs = None
-        self.glssect = None
-        self.glnodes = None
-        self.glpvs = None
+        for attr in self.gllumps:
+            setattr(self, attr, None)
+
+    # GL lumps, in file order. When attached from a GWA file with
+    # attachgl(), they are only read on first access.
+    gllumps = ('glheader', 'glvert', 'glsegs', 'glssect', 'glnodes', 'glpvs')
+
+    def __getattr__(self, attr):
+        if attr in self.gllumps and 'glsource' in self.__dict__:
+            self.loadgl(*self.__dict__.pop('glsource'))
+            return getattr(self, attr)
+        raise AttributeError(attr)
+
+    def attachgl(self, ifile, index, i):
+        """Use the GL lumps whose marker is at index i in another file,
+        replacing the current ones. They are read on first use."""
+        for attr in self.gllumps:
+            self.__dict__.pop(attr, None)
+        self.glsource = (ifile, index, i)
+
+    def loadgl(self, ifile, index, i):
+        """Reads the GL lumps whose marker is at index i."""
+        if i + len(self.gllumps) > len(index) or \
+           index[i + len(self.gllumps) - 1][2] != 'GL_PVS':
+            raise Exception('Malformed GL nodes in GWA file.')
+        for attr, (loffset, lsize, lname) in \
+                zip(self.gllumps, index[i:i + len(self.gllumps)]):
+            ifile.seek(loffset)
+            newlump = lump()
+            newlump.load(ifile, lsize, lname)
+            setattr(self, attr, newlump)
 
     def load(self, ifile, index, i):
         """Loads a level at the current location.
@@ -631,49 +951,16 @@ class level:
         newlump.load(ifile, hsize, hname)
         self.header = newlump
 
-        while i < len(index)-1:
-            i = i+1
-            (hoffset, hsize, hname) = index[i]
+        end = levelend(index, i)
+        for (hoffset, hsize, hname) in index[i+1:end]:
             ifile.seek(hoffset)
             newlump = lump()
             newlump.load(ifile, hsize, hname)
-            if hname == 'THINGS':
-                self.things = newlump
-            elif hname == 'LINEDEFS':
-                self.linedefs = newlump
-            elif hname == 'SIDEDEFS':
-                self.sidedefs = newlump
-            elif hname == 'VERTEXES':
-                self.vertexes = newlump
-            elif hname == 'SEGS':
-                self.segs = newlump
-            elif hname == 'SSECTORS':
-                self.ssectors = newlump
-            elif hname == 'NODES':
-                self.nodes = newlump
-            elif hname == 'SECTORS':
-                self.sectors = newlump
-            elif hname == 'REJECT':
-                self.reject = newlump
-            elif hname == 'BLOCKMAP':
-                self.blockmap = newlump
-            elif hname == 'BEHAVIOR':
-                self.behavior = newlump
-            elif hname == 'GL_' + self.header.name:
+            if hname == 'GL_' + self.header.name:
                 self.glheader = newlump
-            elif hname == 'GL_VERT':
-                self.glvert = newlump
-            elif hname == 'GL_SEGS':
-                self.glsegs = newlump
-            elif hname == 'GL_SSECT':
-                self.ssect = newlump
-            elif hname == 'GL_NODES':
-                self.glnodes = newlump
-            elif hname == 'GL_PVS':
-                self.glpvs = newlump
-            else: # Reached the end. Return new index.
-                return i
-        return i
+            else:
+                setattr(self, levellumps[hname], newlump)
+        return end
 
     def save(self, ofile):
         """Saves level to file. Returns an index array."""
@@ -718,30 +1005,53 @@ class level:
             raise Exception('Data size mismatch when unpacking.')
         return result
 
-    def getvertices(self):
+    def expandarray(self, data, dtype, offset=0):
+        """Like expand(), but returns a numpy structured array built on
+        top of the data, starting at the given offset."""
+        count = (len(data) - offset) / dtype.itemsize
+        if len(data) - offset != count*dtype.itemsize:
+            raise Exception('Data size mismatch when unpacking.')
+        return numpy.frombuffer(data, dtype, count, offset)
+
+    def getvertices(self, asarray=False):
         global glmagicid
         midsize = len(glmagicid)
         if self.glvert.data[0:midsize] != glmagicid: # Version 5 nodes?
             print 'baz', self.glvert.data[0:midsize]
             raise Exception('GL segs not in 5.0 format. %s' %
                             self.header.name)
+        if asarray:
+            return self.expandarray(self.vertexes.data, vertexdtype)
         return self.expand(self.vertexes.data, vertexstruct)
         
 
-    def getlinedefs(self):
+    def getlinedefs(self, asarray=False):
         if self.behavior is None:
+            if asarray:
+                return self.expandarray(self.linedefs.data, doomlinedefdtype)
             return self.expand(self.linedefs.data, doomlinedefstruct)
+        if asarray:
+            return self.expandarray(self.linedefs.data, hexenlinedefdtype)
         return self.expand(self.linedefs.data, hexenlinedefstruct)
 
-    def getthings(self):
+    def getthings(self, asarray=False):
         if self.behavior is None:
+            if asarray:
+                return self.expandarray(self.things.data, doomthingdtype)
             return self.expand(self.things.data, doomthingstruct)
+        if asarray:
+            return self.expandarray(self.things.data, hexenthingdtype)
         return self.expand(self.things.data, hexenthingstruct)
 
-    def getsegs(self):
+    def getsegs(self, asarray=False):
+        if asarray:
+            return self.expandarray(self.segs.data, segdtype)
         return self.expand(self.segs.data, segstruct)
 
-    def getsectors(self):
+    def getsectors(self, asarray=False):
+        # numpy already strips the padding of flat names.
+        if asarray:
+            return self.expandarray(self.sectors.data, sectordtype)
         secs = self.expand(self.sectors.data, sectorstruct)
         result = []
         for s in secs:
@@ -752,81 +1062,114 @@ class level:
             result.append(s)
         return result
 
-    def getsidedefs(self):
+    def getsidedefs(self, asarray=False):
+        if asarray:
+            return self.expandarray(self.sidedefs.data, sidedefdtype)
         return self.expand(self.sidedefs.data, sidedefstruct)
 
-    def getsubsectors(self):
+    def getsubsectors(self, asarray=False):
+        if asarray:
+            return self.expandarray(self.ssectors.data, ssectordtype)
         return self.expand(self.ssectors.data, ssectorstruct)
 
-    def getglvertices(self):
+    def getglvertices(self, asarray=False):
         global glmagicid
         if self.glvert is None:
             raise Exception('Nonexistant GL vertices requested.')
+        if asarray:
+            return self.expandarray(self.glvert.data, glvertdtype,
+                                    len(glmagicid))
         return self.expand(self.glvert.data[len(glmagicid):], glvertstruct)
 
-    def getglsegs(self):
+    def getglsegs(self, asarray=False):
         if self.glsegs is None:
             raise Exception('Nonexistant GL segs requested.')
+        if asarray:
+            return self.expandarray(self.glsegs.data, glsegdtype)
         return self.expand(self.glsegs.data, glsegstruct)
 
-    def getglsubsectors(self):
+    def getglsubsectors(self, asarray=False):
         if self.glssect is None:
             raise Exception('Nonexistan GL subsectors requested.')
+        if asarray:
+            return self.expandarray(self.glssect.data, glssectordtype)
         return self.expand(self.glssect.data, glssectorstruct)
 
+    def getglnodes(self, asarray=False):
+        if self.glnodes is None:
+            raise Exception('Nonexistant GL nodes requested.')
+        if asarray:
+            return self.expandarray(self.glnodes.data, glnodedtype)
+        return self.expand(self.glnodes.data, glnodestruct)
+
 
-    def getblockmap(self):
+    def getblockmap(self, asarray=False):
         """Returns tuple ((xcoord, ycoord), [block lists]). Block list
-        is an array of arrays. The first index is y, the second is x."""
+        is an array of arrays. The first index is y, the second is x.
+
+        With asarray, returns ((xcoord, ycoord), (numcols, numrows),
+        starts, linedefs) instead: the linedefs of block y*numcols + x
+        are linedefs[starts[b]:starts[b+1]]."""
         
         if self.blockmap is None:
             raise Exception('No blockmap in level %s.' % self.header.name)
 
-        blockstart = '\x00\x00' # A list starts with zeros.
-        blockend = '\xff\xff'   # 0xFFFF ends the block list.
         data = self.blockmap.data
         # Does blockmap exist?
         if len(data) == 0:
+            if asarray:
+                return ((0, 0), (1, 1), numpy.zeros(2, numpy.int64),
+                        numpy.zeros(0, numpy.int32))
             return [[0, 0], [[]]]
 
         headersize = struct.calcsize(blockmapheaderstruct)
         header = data[0:headersize]
         (xcoord, ycoord, numcols, numrows) = \
                  struct.unpack(blockmapheaderstruct, header)
-        #print 'cols', numcols, 'rows', numrows
-
-        # Read block offsets.
-        offsets = []
-        for i in range(numcols*numrows):
-            slicestart = headersize + i*2
-            sliceend = slicestart+2
-            coff = struct.unpack('<H', data[slicestart:sliceend])[0]
-            coff *= 2 # Offsets are in shorts, not bytes.
-            offsets.append(coff)
-
-        # Now read in the blocks.
-        blocks = []
-        for y in range(numrows):
-            currow = []
-            blocks.append(currow)
-            for x in range(numcols):
-                curcol = [] # This holds the block list.
-                currow.append(curcol)
-                coff = offsets[y*numcols + x]
-
-                # Consistency check.
-                if data[coff:coff+2] != blockstart:
-                    raise Exception('Blockmap is corrupted.')
-                coff = coff+2
-                while data[coff:coff+2] != blockend:
-                    ldnum = struct.unpack('<H', data[coff:coff+2])[0]
-                    curcol.append(ldnum)
-                    coff += 2
-                #print len(curcol)
-        
+        numblocks = numcols*numrows
+
+        # Everything is in shorts, offsets included.
+        words = numpy.frombuffer(data, '<u2', len(data) / 2)
+        offsets = words[headersize/2:headersize/2 + numblocks]
+        offsets = offsets.astype(numpy.int64)
+        if len(offsets) != numblocks:
+            raise Exception('Blockmap is corrupted.')
+
+        # A list starts with zero, and 0xFFFF ends it. Lists may be
+        # shared between blocks.
+        if numblocks and (offsets.max() >= len(words) or
+                          words[offsets].any()):
+            raise Exception('Blockmap is corrupted.')
+        ends = numpy.flatnonzero(words == 0xFFFF)
+        endidx = numpy.searchsorted(ends, offsets + 1)
+        if numblocks and endidx.max() >= len(ends):
+            raise Exception('Blockmap is corrupted.')
+        counts = ends[endidx] - offsets - 1
+        starts = numpy.zeros(numblocks + 1, numpy.int64)
+        numpy.cumsum(counts, out=starts[1:])
+        positions = numpy.arange(starts[-1]) + \
+                    numpy.repeat(offsets + 1 - starts[:-1], counts)
+        linedefs = words[positions].astype(numpy.int32)
+
+        if asarray:
+            return ((xcoord, ycoord), (numcols, numrows), starts, linedefs)
+
+        lists = [linedefs[starts[b]:starts[b+1]].tolist()
+                 for b in range(numblocks)]
+        blocks = [lists[y*numcols:(y+1)*numcols] for y in range(numrows)]
         result = ((xcoord, ycoord), blocks)
         return result
 
+def levelend(index, i):
+    """Returns the index number of the first item not belonging to
+    the level whose marker is at index i."""
+    glmark = 'GL_' + index[i][2]
+    i = i+1
+    while i < len(index) and \
+              (index[i][2] in levellumps or index[i][2] == glmark):
+        i = i+1
+    return i
+
 def levelsorter(l1, l2):
     """Compares level names and returns -1, 0 or 1."""
     if l1.header.name == l2.header.name:
@@ -854,68 +1197,91 @@ def indexed2rgba(data, palette):
         if len(row) != width:
             raise Exception('Image rows have different lengths.')
 
-    image = []
-    for row in data:
-        for i in row:
-            pal = palette[i]
-            image.append(struct.pack('<BBBB', pal[0], pal[1], pal[2], pal[3]))
-    image = ''.join(image)
+    palette = numpy.asarray(palette, numpy.uint8)
+    image = palette[numpy.asarray(data, numpy.intp)].tostring()
     return (width, height, image)
 
+def histogram(image, mask=None):
+    """Counts the palette indices of the opaque pixels of an indexed numpy
+    image. Returns the 256 bins histogram and the number of transparent
+    pixels."""
+    transparent = 0
+    if mask is not None:
+        image = image[mask]
+        transparent = mask.size - image.size
+    return numpy.bincount(image.ravel(), minlength=256), transparent
+
+def colorstats(counts, transparent, palette):
+    """From a histogram, returns (mean, dominant, transparent fraction) of
+    an image. mean and dominant are (r, g, b) tuples, mean being rounded
+    down; both are black when the image is fully transparent."""
+    rgb = numpy.asarray(palette, numpy.int64)[:, :3]
+    total = int(counts.sum())
+    if total:
+        mean = tuple(int(c) for c in counts.dot(rgb) // total)
+        dominant = tuple(int(c) for c in rgb[counts.argmax()])
+    else:
+        mean = dominant = (0, 0, 0)
+    return mean, dominant, float(transparent) / max(total + transparent, 1)
+
 def buildpatchdict(wadlist):
     """Builds a dictionary that maps a wall patch number (from TEXTURE1)
     to the corresponding patch graphic. The parameter is a sequence of wad
     files starting from the IWAD."""
-    patchdict = {}
     pnamelump = None
+    patches = {}
 
-    # Find the most recent PNAMES.
+    # Find the most recent PNAMES, and the most recent patch of each name.
     for w in wadlist:
         if w.pnames is not None:
             pnamelump = w.pnames
+        patches.update(w.patchindex)
 
-    if pnames is None:
+    if pnamelump is None:
         raise Exception('No PNAMES lump found. Can not process textures.')
 
-
-    # This is not very efficient, but it is only run once and takes <1
-    # second.
-    ind = -1
-    for name in pnamelump.names:
-        ind += 1
-        curpatch = None
-        for w in wadlist:
-            for p in w.patches:
-                if p.name == name:
-                    curpatch = p
-        if curpatch is None:
+    patchdict = {}
+    for ind, name in enumerate(pnamelump.names):
+        if name not in patches:
             raise Exception('Missing patch %s in PNAMES.' % name)
+        patchdict[ind] = patches[name]
+    return patchdict
 
+def buildtexture(texdef, patchdict, transpindex=247, patchcache=None):
+    """Composes a texture from its patches, as an array of arrays. If
+    patchcache is a wad, decoded patches are cached in it.
 
-        patchdict[ind] = curpatch
-                
-
-    return patchdict
+    transpindex is ignored, and only kept for compatibility: transparent
+    patch pixels are the ones outside of the patch posts."""
+    return composetexture(texdef, patchdict, patchcache)[0].tolist()
 
-def buildtexture(texdef, patchdict, transpindex = 247):
-    result = []
-    for y in range(texdef[4]):
-        result += [[0]*texdef[3]]
+def composetexture(texdef, patchdict, patchcache=None):
+    """Composes a texture from its patches. Returns (image, mask) numpy
+    arrays, like patch.decode(): the mask tells which texels are covered by
+    an opaque patch pixel. Patches are clipped to the texture."""
+    width = texdef[3]
+    height = texdef[4]
+    image = numpy.zeros((height, width), numpy.uint8)
+    mask = numpy.zeros((height, width), bool)
 
     for patchdef in texdef[-1]:
         xoff = patchdef[0]
         yoff = patchdef[1]
-        pat = patchdict[patchdef[2]] # No caching -> sloooow.
-        graphic = pat.getgraphic()
-        pw = len(graphic[0])
-        ph = len(graphic)
-        for x in range(pw):
-            for y in range(ph):
-                pixel = graphic[y][x]
-                if pixel == transpindex:
-                    continue
-                try:
-                    result[y+yoff][x+xoff] = pixel
-                except IndexError:
-                    pass
-    return result
+        pat = patchdict[patchdef[2]]
+        if patchcache is not None:
+            pimage, pmask = patchcache.decodepatch(pat)
+        else:
+            pimage, pmask = pat.decode()
+        ph, pw = pimage.shape
+        x0 = max(xoff, 0)
+        x1 = min(xoff + pw, width)
+        y0 = max(yoff, 0)
+        y1 = min(yoff + ph, height)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        src = (slice(y0 - yoff, y1 - yoff), slice(x0 - xoff, x1 - xoff))
+        dst = (slice(y0, y1), slice(x0, x1))
+        opaque = pmask[src]
+        image[dst][opaque] = pimage[src][opaque]
+        mask[dst] |= opaque
+    return image, mask
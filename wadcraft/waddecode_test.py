@@ -0,0 +1,74 @@
+# Wadcraft is a program converting Doom WAD levels to minecraft format.
+# (C) 2011 Pierre Palatin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+import struct
+import unittest
+
+from wadcraft import testwad
+from wadcraft import waddecode
+
+
+def rawlump(data):
+    result = waddecode.lump()
+    result.name = 'TEST'
+    result.data = data
+    return result
+
+
+class LazyLumpTest(unittest.TestCase):
+
+    def test_unpacked_on_access(self):
+        flat = waddecode.flat()
+        flat.fromlump(rawlump('\0' * 4096), lazy=True)
+        self.assertTrue(flat.pending)
+        self.assertEqual((flat.width, flat.height), (64, 64))
+        self.assertFalse(hasattr(flat, 'pending'))
+
+    def test_checked_on_defer(self):
+        flat = waddecode.flat()
+        self.assertRaises(Exception, flat.fromlump, rawlump('\0' * 101),
+                          lazy=True)
+        # Header of a 2 columns wide patch, with a single column offset.
+        patch = waddecode.patch()
+        self.assertRaises(struct.error, patch.fromlump,
+                          rawlump(struct.pack('<HHhhl', 2, 1, 0, 0, 16)),
+                          lazy=True)
+
+    def test_failed_unpack_stays_pending(self):
+        flat = waddecode.flat()
+        flat.fromlump(rawlump('\0' * 4096), lazy=True)
+        flat.data = '\0' * 101
+        for _ in range(2):
+            self.assertRaises(Exception, getattr, flat, 'width')
+            self.assertTrue(flat.pending)
+
+
+class LoadDataTest(unittest.TestCase):
+
+    def test_lazy(self):
+        rawwad = waddecode.wad()
+        rawwad.loaddata(testwad.data(), 'test wad')
+        self.assertEqual([l.name for l in rawwad.flats],
+                         ['FLOOR', 'CEIL', 'FLOOR2', 'F_SKY1'])
+        self.assertTrue(all(f.pending for f in rawwad.flats))
+        self.assertEqual(rawwad.patches[1].width, 32)
+        self.assertEqual(rawwad.levelindex.keys(), ['MAP01'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,8 +15,16 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-"""High level pythonic classes to manipulate WAD data."""
+"""High level pythonic classes to manipulate WAD data.
 
+Level data is stored by column: each kind of object (sector, linedef, ...)
+has a set of numpy arrays in the Level, indexed by object number, and
+references between objects are indices in those arrays. The object classes
+below are lightweight views on these columns.
+"""
+
+
+import numpy
 
 from wadcraft import waddecode
 from wadcraft import waddata
@@ -35,101 +43,135 @@ class Vertex(object):
     return str(self)
 
 
-class Sidedef(object):
-  """A Doom sidedef description"""
+def _column(name, convert=int):
+  """Property reading the entity value in the given level column."""
+  def getter(self):
+    return convert(getattr(self.level, name)[self.index])
+  return property(getter)
+
+
+def _reference(name, entities):
+  """Property resolving an index column to an entity of the given level
+  list. Index -1 is None."""
+  def getter(self):
+    idx = getattr(self.level, name)[self.index]
+    if idx < 0:
+      return None
+    return getattr(self.level, entities)[idx]
+  return property(getter)
+
 
-  def _resolve_texture(self, raw):
-    raw = raw.rstrip('\x00')
-    if raw == '-':
+def _texture(name):
+  """Property resolving an interned texture column to its name."""
+  def getter(self):
+    idx = getattr(self.level, name)[self.index]
+    if idx < 0:
       return None
     # We should cross reference texture object when they are converted really.
-    return raw
+    return self.level.texture_names[idx]
+  return property(getter)
 
-  def __init__(self, level, raw):
+
+class Entity(object):
+  """Base class for level objects, as a view on the level columns."""
+  __slots__ = ('level', 'index')
+
+  def __init__(self, level, index):
     self.level = level
-    self.raw = raw
-    self.texture_x = self.raw[0]
-    self.texture_y = self.raw[1]
+    self.index = index
 
-    self.upper_texture = self._resolve_texture(self.raw[2])
-    self.lower_texture = self._resolve_texture(self.raw[3])
-    self.middle_texture = self._resolve_texture(self.raw[4])
-    self.sector = self.level.sectors[self.raw[5]]
+  def __eq__(self, other):
+    return (type(self) is type(other) and self.index == other.index and
+            self.level is other.level)
 
-    self.sector.sidedefs.append(self)
-    self.linedef = None
-    self.partner = None
+  def __ne__(self, other):
+    return not self == other
 
+  def __hash__(self):
+    return hash(self.index)
 
-class Linedef(object):
-  """A Doom linedef description"""
 
-  def __init__(self, level, raw):
+class EntityList(object):
+  """Sequence of level objects, created on access."""
+
+  def __init__(self, level, factory, count):
     self.level = level
-    self.raw = raw
+    self.factory = factory
+    self.count = count
 
-    self.vertex_start = self.level.verts[raw[0]]
-    self.vertex_end = self.level.verts[raw[1]]
+  def __len__(self):
+    return self.count
 
-    self.flags = raw[2]
-    self.flag_block_player = bool(self.flags & 1)
-    # Many more flags exists obviously.
+  def __getitem__(self, idx):
+    if isinstance(idx, slice):
+      return [self.factory(self.level, i)
+              for i in xrange(*idx.indices(self.count))]
+    if idx < 0:
+      idx += self.count
+    if not 0 <= idx < self.count:
+      raise IndexError(idx)
+    return self.factory(self.level, int(idx))
+
+  def __iter__(self):
+    for i in xrange(self.count):
+      yield self.factory(self.level, i)
 
-    self.special_type = raw[3]
-    self.sector_tag = raw[4]
-    
-    self.right = None
-    if raw[5] != -1:
-      self.right = self.level.sidedefs[raw[5]]
-      self.right.linedef = self
 
-    self.left = None
-    if raw[6] != -1:
-      self.left = self.level.sidedefs[raw[6]]
-      self.left.linedef = self
+def _vertex(level, idx):
+  return Vertex(int(level.vertex_x[idx]), int(level.vertex_y[idx]))
 
-    if self.left and self.right:
-      self.left.partner = self.right
-      self.right.partner = self.left
 
-    # If None, double faced linedef. Otherwise, point to the corresponding
-    # sidedef.
-    self.onesided = None
-    if not (self.left and self.right):
-      self.onesided = self.left or self.right
+class Sidedef(Entity):
+  """A Doom sidedef description"""
+  __slots__ = ()
 
+  texture_x = _column('sidedef_x')
+  texture_y = _column('sidedef_y')
 
-class Segment(object):
-  """A glbsp segment"""
+  upper_texture = _texture('sidedef_upper')
+  lower_texture = _texture('sidedef_lower')
+  middle_texture = _texture('sidedef_middle')
+  sector = _reference('sidedef_sector', 'sectors')
 
-  def __init__(self, level, raw):
-    self.level = level
-    self.raw = raw
+  linedef = _reference('sidedef_linedef', 'linedefs')
+  partner = _reference('sidedef_partner', 'sidedefs')
 
-    self.vertex_start = self.level.verts[raw[0]]
-    self.vertex_end = self.level.verts[raw[1]]
 
-    self.side = raw[3]
-    if raw[2] == 0xffff:
-      self.linedef = None
-      self.sidedef = None
-      self.sector = None
-    else:
-      self.linedef = self.level.linedefs[raw[2]]
-  
-      if self.side == 0:
-        self.sidedef = self.linedef.right
-      else:
-        self.sidedef = self.linedef.left
+class Linedef(Entity):
+  """A Doom linedef description"""
+  __slots__ = ()
 
-      self.sector = self.sidedef.sector
+  vertex_start = _reference('linedef_v1', 'verts')
+  vertex_end = _reference('linedef_v2', 'verts')
+
+  flags = _column('linedef_flags')
+  # Many more flags exists obviously.
+  flag_block_player = property(lambda self: bool(self.flags & 1))
+
+  special_type = _column('linedef_special')
+  sector_tag = _column('linedef_tag')
+
+  right = _reference('linedef_right', 'sidedefs')
+  left = _reference('linedef_left', 'sidedefs')
+
+  # If None, double faced linedef. Otherwise, point to the corresponding
+  # sidedef.
+  onesided = _reference('linedef_onesided', 'sidedefs')
+
+
+class Segment(Entity):
+  """A glbsp segment"""
+  __slots__ = ()
+
+  vertex_start = _reference('segment_v1', 'verts')
+  vertex_end = _reference('segment_v2', 'verts')
+
+  side = _column('segment_side')
+  linedef = _reference('segment_linedef', 'linedefs')
+  sidedef = _reference('segment_sidedef', 'sidedefs')
+  sector = _reference('segment_sector', 'sectors')
+  partner = _reference('segment_partner', 'segments')
 
-  def link(self):
-    if self.raw[4] == 0xffffffff:
-      self.partner = None
-    else:
-      self.partner = self.level.segments[self.raw[4]]
-  
   def __str__(self):
     return 'S(%s,%s)' % (self.vertex_start, self.vertex_end)
 
@@ -137,74 +179,210 @@ class Segment(object):
     return str(self)
 
 
-class Subsector(object):
+class Subsector(Entity):
   """A glbsp subsector description"""
+  __slots__ = ()
 
-  def __init__(self, level, raw):
-    self.level = level
-    self.raw = raw
-
-    count, firstidx = raw
-    self.segments = self.level.segments[firstidx:firstidx+count]
-
-    self.sector = None
-    self.verts = []
-    for seg in self.segments:
-      if not self.verts:
-        self.verts.append(seg.vertex_start)
+  sector = _reference('subsector_sector', 'sectors')
 
-      #assert seg.vertex_start == self.verts[-1]
-      self.verts.append(seg.vertex_end)
-      
-      if seg.sector:
-        if not self.sector:
-          self.sector = seg.sector
-        assert self.sector == seg.sector
+  @property
+  def segments(self):
+    first = self.level.subsector_first[self.index]
+    count = self.level.subsector_count[self.index]
+    return self.level.segments[first:first+count]
 
-    #assert self.verts[0] == self.verts[-1]
-    self.verts.pop()
+  @property
+  def verts(self):
+    """Vertices of the subsector polygon, in segment order."""
+    first = self.level.subsector_first[self.index]
+    count = self.level.subsector_count[self.index]
+    # The start of the first segment, then all segment ends but the last
+    # one, which closes the polygon.
+    idx = [self.level.segment_v1[first]]
+    idx.extend(self.level.segment_v2[first:first+count-1])
+    return [self.level.verts[i] for i in idx]
 
 
-class Sector(object):
+class Sector(Entity):
   """A Doom sector description"""
+  __slots__ = ()
 
-  def __init__(self, level, raw):
-    self.level = level
-    self.raw = raw
-    self.floor = raw[0]
-    self.ceiling = raw[1]
+  floor = _column('sector_floor')
+  ceiling = _column('sector_ceiling')
+  light = _column('sector_light')
+  # type
+  # tag
+
+  @property
+  def floor_flat(self):
+    idx = self.level.sector_floor_flat[self.index]
+    return self.level.wad.flats[self.level.flat_names[idx]]
 
-    self.floor_flat = self.level.wad.flats[raw[2]]
-    self.ceil_flat = self.level.wad.flats[raw[3]]
-    self.light = raw[4]
-    # type
-    # tag
+  @property
+  def ceil_flat(self):
+    idx = self.level.sector_ceil_flat[self.index]
+    return self.level.wad.flats[self.level.flat_names[idx]]
 
-    self.sidedefs = []
+  @property
+  def sidedefs(self):
+    start = self.level.sector_sidedef_start[self.index]
+    end = self.level.sector_sidedef_start[self.index+1]
+    return [self.level.sidedefs[i]
+            for i in self.level.sector_sidedefs[start:end]]
 
 
-class Thing(object):
+class Thing(Entity):
   """A Doom Thing description"""
+  __slots__ = ()
 
-  def __init__(self, level, raw):
-    self.level = level
-    self.raw = raw
+  x = _column('thing_x')
+  y = _column('thing_y')
+  angle = _column('thing_angle')
+  thingtype = _column('thing_type')
+  flags = _column('thing_flags')
+
+  sprite = property(lambda self: waddata.doomdic[self.thingtype])
+
+
+def _spans(starts, counts):
+  """Concatenation of the ranges starts[i]..starts[i]+counts[i]-1."""
+  counts = numpy.asarray(counts, numpy.int64)
+  offsets = numpy.cumsum(counts) - counts
+  return (numpy.arange(counts.sum()) +
+          numpy.repeat(numpy.asarray(starts, numpy.int64) - offsets, counts))
 
-    self.x = raw[0]
-    self.y = raw[1]
-    self.angle = raw[2]
-    self.thingtype = raw[3]
-    self.flags = raw[4]
 
-    self.sprite = waddata.doomdic[self.thingtype]
+class BlockIndex(object):
+  """Uniform grid of linedef lists, like the BLOCKMAP lump.
+
+  Vars:
+    x, y: coordinates of the bottom left corner of the grid.
+    cols, rows: size of the grid, in blocks.
+    size: width and height of a block.
+    starts, linedefs: linedefs of the block at (col, row), whose number is
+      row * cols + col, are linedefs[starts[b]:starts[b+1]].
+  """
+
+  def __init__(self, x, y, cols, rows, starts, linedefs, size=128):
+    self.x = x
+    self.y = y
+    self.cols = cols
+    self.rows = rows
+    self.size = size
+    self.starts = starts
+    self.linedefs = linedefs
+
+  @classmethod
+  def from_blockmap(cls, rawlevel):
+    """Index from the BLOCKMAP lump of the level, or None if it has none."""
+    if rawlevel.blockmap is None or not len(rawlevel.blockmap.data):
+      return None
+    (x, y), (cols, rows), starts, linedefs = rawlevel.getblockmap(
+        asarray=True)
+    return cls(x, y, cols, rows, starts, linedefs)
+
+  @classmethod
+  def from_lines(cls, x1, y1, x2, y2, size=128):
+    """Index of lines given by their end points, each one being put in all
+    the blocks its bounding box overlaps. Like BSP builders do, the grid
+    starts 8 units below the lowest coordinates."""
+    x1, y1, x2, y2 = [numpy.asarray(a, numpy.int64) for a in (x1, y1, x2, y2)]
+    if not len(x1):
+      return cls(0, 0, 1, 1, numpy.zeros(2, numpy.int64),
+                 numpy.zeros(0, numpy.int32), size)
+    x = int(min(x1.min(), x2.min())) - 8
+    y = int(min(y1.min(), y2.min())) - 8
+    cols = (int(max(x1.max(), x2.max())) - x) // size + 1
+    rows = (int(max(y1.max(), y2.max())) - y) // size + 1
+    index = cls(x, y, cols, rows, None, None, size)
+
+    col1, row1, col2, row2 = index._block_ranges(
+        numpy.minimum(x1, x2), numpy.minimum(y1, y2),
+        numpy.maximum(x1, x2), numpy.maximum(y1, y2))
+    line, block = index._expand_blocks(col1, row1, col2, row2)
+    order = numpy.argsort(block, kind='mergesort')
+    index.linedefs = line[order].astype(numpy.int32)
+    index.starts = numpy.zeros(cols * rows + 1, numpy.int64)
+    numpy.cumsum(numpy.bincount(block, minlength=cols * rows),
+                 out=index.starts[1:])
+    return index
+
+  def _block_ranges(self, x1, y1, x2, y2):
+    """Ranges of columns and rows overlapped by boxes, clipped to the
+    grid. Empty when a box is outside."""
+    col1 = numpy.maximum((numpy.asarray(x1) - self.x) // self.size, 0)
+    row1 = numpy.maximum((numpy.asarray(y1) - self.y) // self.size, 0)
+    col2 = numpy.minimum((numpy.asarray(x2) - self.x) // self.size,
+                         self.cols - 1)
+    row2 = numpy.minimum((numpy.asarray(y2) - self.y) // self.size,
+                         self.rows - 1)
+    return col1, row1, col2, row2
+
+  def _expand_blocks(self, col1, row1, col2, row2):
+    """Returns (box, block) pairs for all the blocks of the ranges."""
+    ncols = numpy.maximum(col2 - col1 + 1, 0)
+    nrows = numpy.maximum(row2 - row1 + 1, 0)
+    box = numpy.repeat(numpy.arange(len(ncols)), ncols * nrows)
+    cell = _spans(numpy.zeros(len(ncols)), ncols * nrows)
+    col = col1[box] + cell % ncols[box]
+    row = row1[box] + cell // ncols[box]
+    return box, row * self.cols + col
+
+  def _gather(self, query, block):
+    """Returns (query, linedef) pairs for the linedefs of the blocks."""
+    counts = self.starts[block + 1] - self.starts[block]
+    return (numpy.repeat(query, counts),
+            self.linedefs[_spans(self.starts[block], counts)])
+
+  def points(self, x, y):
+    """Linedefs of the blocks containing points.
+
+    Returns:
+      (point, linedef) arrays, with one entry per linedef of the block of
+      each point. Points outside the grid have none.
+    """
+    x = numpy.asarray(x, numpy.int64)
+    y = numpy.asarray(y, numpy.int64)
+    col = (x - self.x) // self.size
+    row = (y - self.y) // self.size
+    inside = (col >= 0) & (col < self.cols) & (row >= 0) & (row < self.rows)
+    point = numpy.flatnonzero(inside)
+    return self._gather(point, row[inside] * self.cols + col[inside])
+
+  def boxes(self, x1, y1, x2, y2):
+    """Linedefs of the blocks overlapping boxes, with x1 <= x2, y1 <= y2.
+
+    Returns:
+      (box, linedef) arrays, sorted, with each linedef once per box.
+    """
+    box, block = self._expand_blocks(*self._block_ranges(
+        numpy.asarray(x1, numpy.int64), numpy.asarray(y1, numpy.int64),
+        numpy.asarray(x2, numpy.int64), numpy.asarray(y2, numpy.int64)))
+    box, linedef = self._gather(box, block)
+    count = int(self.linedefs.max()) + 1 if len(self.linedefs) else 1
+    key = numpy.unique(box * count + linedef)
+    return key // count, (key % count).astype(numpy.int32)
 
 
 class Level(object):
   """Help manipulating a Doom level.
   
   Vars:
-    verts: {int: Vertex}, dict of all the vertices, both regular and gl ones.
+    verts: [Vertex], all the vertices, regular ones first then gl ones.
+    vertex_x, vertex_y: numpy arrays of vertex coordinates.
+    sectors, sidedefs, linedefs, segments, subsectors, things: lists of
+      views on the corresponding <kind>_<attribute> columns.
+    flat_names, texture_names: interned names used in sector flat and
+      sidedef texture columns. Texture index -1 means no texture.
     bbox1: Vertex
+    blocks: BlockIndex of linedefs, built on first use.
+    node_x, node_y, node_dx, node_dy: partition lines of the GL BSP nodes.
+    node_right, node_left: children of the nodes; node index, or ~subsector.
+    sector_neighbors, sector_neighbor_start: sectors sharing a two-sided
+      linedef with sector i are sector_neighbors[start[i]:start[i+1]].
+    sector_open_ceiling: ceiling, with closed doors (floor == ceiling)
+      opened up to the highest neighbor ceiling.
+    sector_sky: whether the ceiling is a sky flat.
   """
 
   def __init__(self, wad, rawlevel):
@@ -217,79 +395,274 @@ class Level(object):
     self._get_sectors()
     self._get_sidedefs()
     self._get_linedefs()
+    self._get_sector_graph()
     self._get_segments()
     self._get_subsectors()
+    self._get_nodes()
     self._get_things()
     self._boundingbox()
 
+  @property
+  def blocks(self):
+    # Use the BLOCKMAP lump when there is one. It might be missing, e.g.
+    # with some node builders, so rebuild an equivalent grid then.
+    if not hasattr(self, '_blocks'):
+      self._blocks = BlockIndex.from_blockmap(self.rawlevel)
+      if self._blocks is None:
+        self._blocks = BlockIndex.from_lines(
+            self.vertex_x[self.linedef_v1], self.vertex_y[self.linedef_v1],
+            self.vertex_x[self.linedef_v2], self.vertex_y[self.linedef_v2])
+    return self._blocks
+
+  def linedefs_near(self, x, y):
+    """Batched point query: (point, linedef) arrays of the linedefs
+    sharing a block with each point."""
+    return self.blocks.points(x, y)
+
+  def linedefs_in_boxes(self, x1, y1, x2, y2):
+    """Batched box query, with x1 <= x2 and y1 <= y2.
+
+    Returns:
+      sorted (box, linedef) arrays, with one entry for each linedef
+      touching each box.
+    """
+    x1, y1, x2, y2 = [numpy.asarray(a, numpy.int64) for a in (x1, y1, x2, y2)]
+    box, linedef = self.blocks.boxes(x1, y1, x2, y2)
+    lx1 = self.vertex_x[self.linedef_v1[linedef]].astype(numpy.int64)
+    ly1 = self.vertex_y[self.linedef_v1[linedef]].astype(numpy.int64)
+    lx2 = self.vertex_x[self.linedef_v2[linedef]].astype(numpy.int64)
+    ly2 = self.vertex_y[self.linedef_v2[linedef]].astype(numpy.int64)
+    bx1, by1, bx2, by2 = x1[box], y1[box], x2[box], y2[box]
+
+    # The bounding boxes must overlap...
+    touch = ((numpy.minimum(lx1, lx2) <= bx2) &
+             (numpy.maximum(lx1, lx2) >= bx1) &
+             (numpy.minimum(ly1, ly2) <= by2) &
+             (numpy.maximum(ly1, ly2) >= by1))
+    # ... and the box corners must not all be strictly on the same side.
+    sides = [numpy.sign((lx2 - lx1) * (cy - ly1) - (ly2 - ly1) * (cx - lx1))
+             for cx, cy in ((bx1, by1), (bx1, by2), (bx2, by1), (bx2, by2))]
+    same = ((sides[0] == sides[1]) & (sides[1] == sides[2]) &
+            (sides[2] == sides[3]) & (sides[0] != 0))
+    touch &= ~same
+    return box[touch], linedef[touch]
+
   def _get_vertices(self):
-    # Create a unique dict of all vertices. We use a dict, so we can have direct
-    # access for both regular and gl vertices.
-    self.verts = {}
-    for i, v in enumerate(self.rawlevel.getvertices()):
-      self.verts[i] = Vertex(v[0], v[1])
-
-    for i, v in enumerate(self.rawlevel.getglvertices()):
-      v_idx = i | (1<<31)
-      self.verts[v_idx] = Vertex(v[1], v[3])
+    # Regular and gl vertices share a single index space, so we have direct
+    # access to both of them. Gl vertices come after the regular ones.
+    verts = self.rawlevel.getvertices(asarray=True)
+    glverts = self.rawlevel.getglvertices(asarray=True)
+    self.num_regular_verts = len(verts)
+    self.vertex_x = numpy.concatenate(
+        (verts['x'], glverts['x'])).astype(numpy.int32)
+    self.vertex_y = numpy.concatenate(
+        (verts['y'], glverts['y'])).astype(numpy.int32)
+    self.verts = EntityList(self, _vertex, len(self.vertex_x))
+
+  def _vertex_index(self, refs):
+    """Convert glbsp vertex references to vertex column indices."""
+    refs = refs.astype(numpy.int64)
+    gl_vertex = (refs & (1<<31)) != 0
+    return numpy.where(
+        gl_vertex, (refs & 0x7fffffff) + self.num_regular_verts, refs)
   
   def _get_sectors(self):
-    self.sectors = []
-    for sector in self.rawlevel.getsectors():
-      self.sectors.append(Sector(self, sector))
+    sectors = self.rawlevel.getsectors(asarray=True)
+    self.sector_floor = sectors['floor'].astype(numpy.int32)
+    self.sector_ceiling = sectors['ceiling'].astype(numpy.int32)
+    self.sector_light = sectors['light'].astype(numpy.int32)
+
+    names, ids = numpy.unique(
+        numpy.concatenate((sectors['floorflat'], sectors['ceilflat'])),
+        return_inverse=True)
+    self.flat_names = [str(n).split('\0')[0] for n in names]
+    self.sector_floor_flat = ids[:len(sectors)]
+    self.sector_ceil_flat = ids[len(sectors):]
+
+    self.sectors = EntityList(self, Sector, len(sectors))
 
   def _get_sidedefs(self):
-    self.sidedefs = []
-    for sidedef in self.rawlevel.getsidedefs():
-      self.sidedefs.append(Sidedef(self, sidedef))
+    sidedefs = self.rawlevel.getsidedefs(asarray=True)
+    count = len(sidedefs)
+    self.sidedef_x = sidedefs['xoffset'].astype(numpy.int32)
+    self.sidedef_y = sidedefs['yoffset'].astype(numpy.int32)
+    self.sidedef_sector = sidedefs['sector'].astype(numpy.intp)
+
+    names, ids = numpy.unique(
+        numpy.concatenate(
+            (sidedefs['upper'], sidedefs['lower'], sidedefs['middle'])),
+        return_inverse=True)
+    self.texture_names = [str(n) for n in names]
+    if '-' in self.texture_names:
+      ids[ids == self.texture_names.index('-')] = -1
+    self.sidedef_upper = ids[:count]
+    self.sidedef_lower = ids[count:2*count]
+    self.sidedef_middle = ids[2*count:]
+
+    # Sidedefs of each sector, as ranges of sector_sidedefs.
+    self.sector_sidedefs = numpy.argsort(self.sidedef_sector, kind='mergesort')
+    self.sector_sidedef_start = numpy.searchsorted(
+        self.sidedef_sector[self.sector_sidedefs],
+        numpy.arange(len(self.sectors)+1))
+
+    # Filled when reading linedefs.
+    self.sidedef_linedef = numpy.full(count, -1, numpy.intp)
+    self.sidedef_partner = numpy.full(count, -1, numpy.intp)
+
+    self.sidedefs = EntityList(self, Sidedef, count)
 
   def _get_linedefs(self):
-    self.linedefs = []
-    for linedef in self.rawlevel.getlinedefs():
-      self.linedefs.append(Linedef(self, linedef))
+    linedefs = self.rawlevel.getlinedefs(asarray=True)
+    self.linedef_v1 = linedefs['v1'].astype(numpy.intp)
+    self.linedef_v2 = linedefs['v2'].astype(numpy.intp)
+    self.linedef_flags = linedefs['flags'].astype(numpy.int32)
+    self.linedef_special = linedefs['special'].astype(numpy.int32)
+    if 'tag' in linedefs.dtype.names:
+      self.linedef_tag = linedefs['tag'].astype(numpy.int32)
+    else:
+      # Hexen linedefs have arguments instead of a tag.
+      self.linedef_tag = numpy.zeros(len(linedefs), numpy.int32)
+    right = self.linedef_right = linedefs['right'].astype(numpy.intp)
+    left = self.linedef_left = linedefs['left'].astype(numpy.intp)
+
+    has_right = right != -1
+    has_left = left != -1
+    self.sidedef_linedef[right[has_right]] = numpy.flatnonzero(has_right)
+    self.sidedef_linedef[left[has_left]] = numpy.flatnonzero(has_left)
+
+    twosided = has_right & has_left
+    self.sidedef_partner[left[twosided]] = right[twosided]
+    self.sidedef_partner[right[twosided]] = left[twosided]
+
+    self.linedef_onesided = numpy.where(
+        twosided, -1, numpy.where(has_left, left, right))
+
+    self.linedefs = EntityList(self, Linedef, len(linedefs))
+
+  def _get_sector_graph(self):
+    count = len(self.sectors)
+    # Linedefs can also have no side at all; -1 must not be used as an index.
+    twosided = (self.linedef_right != -1) & (self.linedef_left != -1)
+    right = self.sidedef_sector[self.linedef_right[twosided]]
+    left = self.sidedef_sector[self.linedef_left[twosided]]
+    pairs = numpy.unique(numpy.concatenate((right, left)) * count +
+                         numpy.concatenate((left, right)))
+    sector, neighbor = pairs // count, pairs % count
+    keep = sector != neighbor
+    sector, neighbor = sector[keep], neighbor[keep]
+    self.sector_neighbors = neighbor
+    self.sector_neighbor_start = numpy.searchsorted(
+        sector, numpy.arange(count+1))
+
+    # Doors are considered open, up to their highest neighbor ceiling.
+    floor = self.sector_floor
+    ceiling = self.sector_ceiling
+    highest = ceiling.copy()
+    has_neighbors = numpy.diff(self.sector_neighbor_start) > 0
+    if len(neighbor):
+      first = self.sector_neighbor_start[:-1][has_neighbors]
+      highest[has_neighbors] = numpy.maximum(
+          ceiling[has_neighbors],
+          numpy.maximum.reduceat(ceiling[neighbor], first))
+    self.sector_open_ceiling = numpy.where(floor == ceiling, highest, ceiling)
+
+    sky = numpy.array(['sky' in n.lower() for n in self.flat_names], bool)
+    self.sector_sky = sky[self.sector_ceil_flat]
 
   def _get_segments(self):
-    self.segments = []
-    for seg in self.rawlevel.getglsegs():
-      self.segments.append(Segment(self, seg))
-
-    for seg in self.segments:
-      seg.link()
+    segs = self.rawlevel.getglsegs(asarray=True)
+    count = len(segs)
+    self.segment_v1 = self._vertex_index(segs['v1'])
+    self.segment_v2 = self._vertex_index(segs['v2'])
+    self.segment_side = segs['side'].astype(numpy.int32)
+
+    linedef = segs['linedef'].astype(numpy.intp)
+    linedef[linedef == 0xffff] = -1
+    self.segment_linedef = linedef
+
+    # Minisegs have no linedef, so no sidedef nor sector.
+    has_linedef = linedef != -1
+    on_right = self.segment_side[has_linedef] == 0
+    self.segment_sidedef = numpy.full(count, -1, numpy.intp)
+    self.segment_sidedef[has_linedef] = numpy.where(
+        on_right,
+        self.linedef_right[linedef[has_linedef]],
+        self.linedef_left[linedef[has_linedef]])
+
+    has_sidedef = self.segment_sidedef != -1
+    self.segment_sector = numpy.full(count, -1, numpy.intp)
+    self.segment_sector[has_sidedef] = self.sidedef_sector[
+        self.segment_sidedef[has_sidedef]]
+
+    partner = segs['partner'].astype(numpy.int64)
+    partner[partner == 0xffffffff] = -1
+    self.segment_partner = partner
+
+    self.segments = EntityList(self, Segment, count)
 
   def _get_subsectors(self):
-    self.subsectors = []
-    for s in self.rawlevel.getglsubsectors():
-      self.subsectors.append(Subsector(self, s))
+    ssects = self.rawlevel.getglsubsectors(asarray=True)
+    count = len(ssects)
+    self.subsector_count = ssects['count'].astype(numpy.intp)
+    self.subsector_first = ssects['first'].astype(numpy.intp)
+
+    # Owning subsector of each segment, and segment index.
+    owner = numpy.repeat(numpy.arange(count), self.subsector_count)
+    starts = numpy.cumsum(self.subsector_count) - self.subsector_count
+    seg_idx = (numpy.repeat(self.subsector_first - starts,
+                            self.subsector_count) +
+               numpy.arange(len(owner)))
+
+    # The sector of a subsector is the one of its first segment having one.
+    seg_sector = self.segment_sector[seg_idx]
+    has_sector = seg_sector != -1
+    owner = owner[has_sector]
+    seg_sector = seg_sector[has_sector]
+    ssect_idx, first_seg = numpy.unique(owner, return_index=True)
+    self.subsector_sector = numpy.full(count, -1, numpy.intp)
+    self.subsector_sector[ssect_idx] = seg_sector[first_seg]
+    assert (self.subsector_sector[owner] == seg_sector).all()
+
+    self.subsectors = EntityList(self, Subsector, count)
+
+  def _get_nodes(self):
+    # Children are node indices, or ~subsector for subsectors. The root is
+    # the last node.
+    nodes = self.rawlevel.getglnodes(asarray=True)
+    self.node_x = nodes['x'].astype(numpy.int32)
+    self.node_y = nodes['y'].astype(numpy.int32)
+    self.node_dx = nodes['dx'].astype(numpy.int32)
+    self.node_dy = nodes['dy'].astype(numpy.int32)
+    for side in ('right', 'left'):
+      child = nodes[side].astype(numpy.int64)
+      is_subsector = (child & (1<<31)) != 0
+      setattr(self, 'node_' + side,
+              numpy.where(is_subsector, ~(child & 0x7fffffff), child))
 
   def _get_things(self):
-    self.things = []
-    for t in self.rawlevel.getthings():
-      self.things.append(Thing(self, t))
+    things = self.rawlevel.getthings(asarray=True)
+    self.thing_x = things['x'].astype(numpy.int32)
+    self.thing_y = things['y'].astype(numpy.int32)
+    self.thing_angle = things['angle'].astype(numpy.int32)
+    self.thing_type = things['type'].astype(numpy.int32)
+    self.thing_flags = things['flags'].astype(numpy.int32)
+    self.things = EntityList(self, Thing, len(things))
 
   def _boundingbox(self):
     # Build a bounding box so we have an idea where we're going
-    self.bbox1 = Vertex(self.verts[0].x, self.verts[0].y)
-    self.bbox2 = Vertex(self.verts[0].x, self.verts[0].y)
-    for v in self.verts.itervalues():
-      self.bbox1.x = min(self.bbox1.x, v.x)
-      self.bbox1.y = min(self.bbox1.y, v.y)
-
-      self.bbox2.x = max(self.bbox2.x, v.x)
-      self.bbox2.y = max(self.bbox2.y, v.y)
+    self.bbox1 = Vertex(int(self.vertex_x.min()), int(self.vertex_y.min()))
+    self.bbox2 = Vertex(int(self.vertex_x.max()), int(self.vertex_y.max()))
 
     # Check min/max height
-    self.min_height = self.sectors[0].floor
-    self.max_height = self.sectors[0].ceiling
-    for s in self.sectors:
-      self.min_height = min(self.min_height, s.floor)
-      self.max_height = max(self.max_height, s.ceiling)
+    self.min_height = int(self.sector_floor.min())
+    self.max_height = int(self.sector_ceiling.max())
 
 
 class Wad(object):
   def __init__(self, rawwad):
     self.rawwad = rawwad
     
-    self.flats = dict([(f.name, f) for f in self.rawwad.flats])
+    self.flats = self.rawwad.flatindex
     self.playpal = self.rawwad.playpal
     self.patchdict = waddecode.buildpatchdict([self.rawwad])
 
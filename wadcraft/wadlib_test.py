@@ -0,0 +1,86 @@
+# Wadcraft is a program converting Doom WAD levels to minecraft format.
+# (C) 2011 Pierre Palatin
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+import unittest
+
+from wadcraft import testwad
+from wadcraft import wadlib
+
+
+class SectorGraphTest(unittest.TestCase):
+
+  def setUp(self):
+    wad = testwad.load()
+    self.level = wadlib.Level(wad, wad.rawwad.levelindex['MAP01'])
+
+  def neighbors(self):
+    start = self.level.sector_neighbor_start
+    return [list(self.level.sector_neighbors[start[i]:start[i+1]])
+            for i in range(len(start) - 1)]
+
+  def test_neighbors(self):
+    self.assertEqual(self.neighbors(), [[1], [0, 2], [1]])
+
+  def test_open_ceiling(self):
+    # The closed door opens up to the sky room ceiling.
+    self.assertEqual(list(self.level.sector_open_ceiling), [128, 160, 160])
+
+  def test_sky(self):
+    self.assertEqual(list(self.level.sector_sky), [False, False, True])
+
+  def test_missing_side(self):
+    # A linedef without right side links no sectors. -1 must not be taken
+    # as the last sidedef, which is moved to the first room.
+    self.level.linedef_right[6] = -1
+    self.level.sidedef_sector[-1] = 0
+    self.level._get_sector_graph()
+    self.assertEqual(self.neighbors(), [[1], [0], []])
+    self.assertEqual(list(self.level.sector_open_ceiling), [128, 128, 160])
+
+class BlockIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    wad = testwad.load()
+    self.level = wadlib.Level(wad, wad.rawwad.levelindex['MAP01'])
+
+  def test_from_lines_matches_blockmap(self):
+    level = self.level
+    blockmap = level.blocks
+    rebuilt = wadlib.BlockIndex.from_lines(
+        level.vertex_x[level.linedef_v1], level.vertex_y[level.linedef_v1],
+        level.vertex_x[level.linedef_v2], level.vertex_y[level.linedef_v2])
+    self.assertEqual((rebuilt.x, rebuilt.y, rebuilt.cols, rebuilt.rows),
+                     (blockmap.x, blockmap.y, blockmap.cols, blockmap.rows))
+    self.assertEqual(list(rebuilt.starts), list(blockmap.starts))
+    self.assertEqual(list(rebuilt.linedefs), list(blockmap.linedefs))
+
+  def test_points(self):
+    # The last point is outside of the grid.
+    point, linedef = self.level.linedefs_near([10, 300, -100], [10, 200, 0])
+    self.assertEqual(zip(point, linedef), [(0, 0), (0, 2), (1, 3), (1, 6)])
+
+  def test_boxes(self):
+    box, linedef = self.level.blocks.boxes([0, 540], [0, 100], [300, 540],
+                                           [100, 100])
+    self.assertEqual(zip(box, linedef),
+                     [(0, 0), (0, 2), (0, 3), (0, 5), (0, 6), (0, 9),
+                      (1, 8), (1, 9)])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -21,28 +21,34 @@
 from wadcraft import waddecode
 
 
-def mergearray(target, source, levels=False):
-  """Adds and overwrites graphics from the source to target arrays."""
-  for sgra in source:
-    overwritten = 0
-    for i in range(len(target)):
-      tgra = target[i]
+def mergearray(target, source, levels=False, index=None, positions=None):
+  """Adds and overwrites graphics from the source to target arrays.
+
+  If index is a name -> lump dictionary of target, it is updated too.
+  positions maps names to the position of their first lump in target; it
+  is computed if not given, and kept up to date.
+  """
+  if levels: # Are we dealing with levels?
+    getname = lambda l: l.header.name
+  else:
+    getname = lambda l: l.name
 
-      # If the lump exists, overwrite it.
-      if levels: # Are we dealing with levels?
-        tname = tgra.header.name
-        sname = sgra.header.name
-      else:
-        tname = tgra.name
-        sname = sgra.name
-      if tname == sname:
-        overwritten = 1
-        target[i] = sgra
-        break
+  if positions is None:
+    positions = {}
+    for i, tgra in enumerate(target):
+      positions.setdefault(getname(tgra), i)
 
-    # If graphic was not overwritten, append it.
-    if overwritten == 0:
+  for sgra in source:
+    sname = getname(sgra)
+    # If the lump exists, overwrite it, otherwise append it.
+    i = positions.get(sname)
+    if i is None:
+      positions[sname] = len(target)
       target.append(sgra)
+    else:
+      target[i] = sgra
+    if index is not None:
+      index[sname] = sgra
 
 
 def mergewad(target, source):
@@ -52,8 +58,11 @@ def mergewad(target, source):
 
   # Only display levels from the lastest wad file.
   if source.levels is not None:
-    mergearray(target.levels, source.levels, True)
+    mergearray(target.levels, source.levels, True, target.levelindex,
+               target.levelpositions)
     target.levels.sort(waddecode.levelsorter)
+    # There are only a few levels, unlike graphics.
+    target.buildlevelpositions()
 
   if source.playpal is not None:
     target.playpal = source.playpal
@@ -62,5 +71,9 @@ def mergewad(target, source):
   # lossage.
   #target.fname = os.path.basename(source.fname)
 
-  mergearray(target.sprites, source.sprites)
-  mergearray(target.flats, source.flats)
+  mergearray(target.sprites, source.sprites, index=target.spriteindex,
+             positions=target.spritepositions)
+  mergearray(target.flats, source.flats, index=target.flatindex,
+             positions=target.flatpositions)
+  mergearray(target.patches, source.patches, index=target.patchindex,
+             positions=target.patchpositions)